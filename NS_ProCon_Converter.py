@@ -1,38 +1,29 @@
 #!/usr/bin/env python3
 
 import asyncio
+import configparser
 import errno
 import os
 import signal
 import time
-from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from typing import Dict, List
 
 import evdev
-import evdev.ecodes as ev
 from evdev import InputDevice
 
 import nscon
-from nscon import set_controller_input
-
-if not os.path.exists('/sys/kernel/config/usb_gadget/procon'):
-    print('ProCon Gadget does not exists. Please run add_procon_gadget.sh')
-    os._exit(1)
-
-# Reset USB Gadget
-os.system('echo > /sys/kernel/config/usb_gadget/procon/UDC')
-os.system('ls /sys/class/udc > /sys/kernel/config/usb_gadget/procon/UDC')
-
-time.sleep(0.5)
-
-gadget_path: str = '/dev/hidg0'
-if os.path.exists(gadget_path):
-    ProCon = nscon.Controller(gadget_path)
-else:
-    print('Gadget Path does not exists.')
-    raise FileNotFoundError(
-        errno.ENOENT, os.strerror(errno.ENOENT), gadget_path)
+from configwatch import ConfigWatcher
+from control import ControlServer
+from devices import DeviceManager, guess_devices
+from gadget import Gadget
+from gyrofilter import compile_filters
+from keymap import KeyMap, compile_keymap
+from metrics import MetricsServer
+from record import Recorder, play
+from rtreport import ReportProcess
+from spiflash import SpiFlash
+from ticker import Ticker
 
 # ////////////////////////////////USERCONFIG////////////////////////////////////
 
@@ -41,91 +32,266 @@ config_ini_path: str = "config.ini"
 
 if os.path.exists(config_ini_path):
     config_ini.read(config_ini_path, encoding='utf-8')
-    keyconfig: ConfigParser = config_ini['KEYCONFIG']
-    devconfig: ConfigParser = config_ini['DEVICE']
 else:
     print('Config File does not exists. Please check config.ini file path.')
     raise FileNotFoundError(errno.ENOENT, os.strerror(
         errno.ENOENT), config_ini_path)
 
-devices: List[InputDevice] = [InputDevice(
-    path) for path in evdev.list_devices()]
-
-mouse = None
-keybd = None
-
-for dev in devices:
-    devcapa = dev.capabilities()
-    ecREL = ev.ecodes['EV_REL']
-    ecKEY = ev.ecodes['EV_KEY']
-    ecBTNMOUSE = ev.ecodes['BTN_MOUSE']
-    if (ecREL in devcapa) and (ecBTNMOUSE in devcapa[ecKEY]):
-        mouse = dev
-    elif (ecREL not in devcapa) and (ecKEY in devcapa):
-        keybd = dev
-
-if not mouse or not keybd:
-    print('Input Device dose not exists. Please check valid device list.')
-    print('Valid Device List')
-    for device in devices:
-        print(f'\t{device.path} {device.name} {device.phys}')
-    os._exit(1)
-else:
-    print("Mouse: ", mouse.name)
-    print("Keyboard: ", keybd.name)
 
-evkeys: Dict[int, str] = {ev.ecodes[key.upper()]: key.upper()
-                          for key in keyconfig}
-turn_dots: float = float(devconfig['MouseDPI']) * \
-    (float(devconfig['MouseTurnDistance']) / 2.54)
-dot_per_degree: float = (turn_dots / 180)
-ProCon.Input.Sensor.Gyro.Sensitivity = dot_per_degree
-ProCon.LogLevel = 2
+def read_devconfigs(config: ConfigParser) -> List[Dict[str, str]]:
+    # [DEVICE] describes the first controller (/dev/hidg0 on the "procon"
+    # gadget). Every [CONTROLLERn] section adds another one and overrides the
+    # [DEVICE] settings it names.
+    devconfigs: List[Dict[str, str]] = [dict(config['DEVICE'])]
+    for section in config.sections():
+        if section.startswith('CONTROLLER'):
+            devconfigs.append({**config['DEVICE'], **config[section],
+                               'name': section})
+    devconfigs[0].setdefault('hiddevice', '/dev/hidg0')
+    devconfigs[0].setdefault('usbgadget', 'procon')
+
+    for devconfig in devconfigs[1:]:
+        if 'hiddevice' not in devconfig or 'usbgadget' not in devconfig:
+            raise ValueError(f'[{devconfig["name"]}] needs its own UsbGadget and HidDevice.')
+
+    # Inherited settings would make two controllers share one gadget, UDC,
+    # device, SPI flash image or recording. Without Udc a free one is used.
+    for key, option in [('usbgadget', 'UsbGadget'), ('udc', 'Udc'), ('hiddevice', 'HidDevice'),
+                        ('spiflash', 'SpiFlash'), ('record', 'Record')]:
+        used: Dict[str, str] = {}
+        for devconfig in devconfigs:
+            if key not in devconfig:
+                continue
+            path: str = devconfig[key] if key in ['usbgadget', 'udc'] else os.path.abspath(devconfig[key])
+            if path in used:
+                raise ValueError(f'[{devconfig.get("name", "DEVICE")}] needs its own {option}, '
+                                 f'{devconfig[key]} is already used by [{used[path]}].')
+            used[path] = devconfig.get('name', 'DEVICE')
+    return devconfigs
+
+
+def input_settings(config: ConfigParser, devconfig: Dict[str, str], procon: nscon.Controller):
+    # Everything that can be changed while running: returns the keymap, gyro
+    # sensitivity, gyro filter chains and the GYROFILTER section.
+    keymap: KeyMap = compile_keymap(procon.Input, config[devconfig.get('keyconfig', 'KEYCONFIG')])
+
+    turn_dots: float = float(devconfig['mousedpi']) * \
+        (float(devconfig['mouseturndistance']) / 2.54)
+    dot_per_degree: float = (turn_dots / 180)
+
+    filter_section: str = devconfig.get('gyrofilter', 'GYROFILTER')
+    filters: Dict[str, str] = {}
+    if filter_section in config:
+        filters = dict(config[filter_section])
+    elif 'gyrofilter' in devconfig:
+        raise ValueError(f'GyroFilter section [{filter_section}] does not exist.')
+
+    return keymap, dot_per_degree, compile_filters(filters), filters
+
+
+try:
+    devconfigs: List[Dict[str, str]] = read_devconfigs(config_ini)
+except (KeyError, ValueError) as e:
+    print(e)
+    os._exit(1)
 
 # //////////////////////////////////////////////////////////////////////////////
 
-# TODO: REL_WHEEL
-async def mouse_events(mouse: InputDevice):
-    async for event in mouse.async_read_loop():
-        if event.type == ev.ecodes['EV_REL'] and event.code in [ev.ecodes['REL_X'], ev.ecodes['REL_Y']]:
-            if event.code == ev.ecodes['REL_X']:
-                ProCon.Input.Sensor.Gyro.Z -= event.value
-            elif event.code == ev.ecodes['REL_Y']:
-                ProCon.Input.Sensor.Gyro.Y += event.value
-        elif event.type == ev.ecodes['EV_KEY'] and event.code in evkeys:
-            set_controller_input(
-                ProCon.Input, keyconfig[evkeys[event.code]], event.value)
-
-
-async def keybd_events(keybd: InputDevice):
-    async for event in keybd.async_read_loop():
-        if event.type == ev.ecodes['EV_KEY'] and event.code in evkeys:
-            ConInput = keyconfig[evkeys[event.code]]
-            if ConInput.endswith(('STICK_UP', 'STICK_RIGHT')):
-                set_value = 0xFFF if event.value else 0x800
-            elif ConInput.endswith(('STICK_DOWN', 'STICK_LEFT')):
-                set_value = 0x000 if event.value else 0x800
-            else:
-                set_value = event.value
-            set_controller_input(ProCon.Input, ConInput, set_value)
-
-
-def hand(signal, frame):
-    ProCon.Disconnect()
-    ProCon.Close()
-    os.system('echo > /sys/kernel/config/usb_gadget/procon/UDC')
-    os.system('ls /sys/class/udc > /sys/kernel/config/usb_gadget/procon/UDC')
-    time.sleep(0.5)
+gadgets: List[Gadget] = [Gadget(devconfig['usbgadget'], devconfig.get('udc'), devconfig['hiddevice'])
+                         for devconfig in devconfigs]
+
+for gadget in gadgets:
+    if not gadget.exists():
+        print(f'ProCon Gadget {gadget.name} does not exists. Please run add_procon_gadget.sh')
+        os._exit(1)
+
+# Reset USB Gadget
+try:
+    for gadget in gadgets:
+        gadget.reset()
+except OSError as e:
+    print(f'Cannot reset the USB gadget: {e}')
     os._exit(1)
 
+for gadget in gadgets:
+    if not gadget.waitDevice():
+        print(f'{gadget.device} did not appear after enabling {gadget.name}.')
+        os._exit(1)
+
+
+def input_specs(devconfig: Dict[str, str], key: str) -> List[str]:
+    return [spec.strip() for spec in devconfig.get(key, '').split(',') if spec.strip()]
 
-ProCon.startConnect()
 
-asyncio.ensure_future(mouse_events(mouse))
-asyncio.ensure_future(keybd_events(keybd))
+engine: Ticker = Ticker()
+controllers: List[nscon.Controller] = []
+recorders: List[Recorder] = []
+keymaps: List[KeyMap] = []
+manager: DeviceManager = DeviceManager()
+
+for devconfig, gadget in zip(devconfigs, gadgets):
+    gadget_path: str = devconfig['hiddevice']
+    ProCon = nscon.Controller(gadget_path, engine=engine)
+    ProCon.enabledAt = gadget.enabledAt
+
+    try:
+        keymap, dot_per_degree, gyro_filters, filters = input_settings(config_ini, devconfig, ProCon)
+    except (KeyError, ValueError) as e:
+        print(e)
+        os._exit(1)
+
+    ProCon.Input.Sensor.Gyro.Sensitivity = dot_per_degree
+    ProCon.gyroFilters = gyro_filters
+    if filters:
+        latency: float = max([chain.latency for chain in gyro_filters if chain is not None], default=0.0)
+        print(f'{gadget_path} Gyro filter latency: {latency * 1000:.1f} ms')
+
+    if 'spiflash' in devconfig:
+        try:
+            ProCon.flash = SpiFlash(devconfig['spiflash'], nscon.SPI_ROM_DATA)
+        except ValueError as e:
+            print(e)
+            os._exit(1)
+    ProCon.LogLevel = 2
+
+    try:
+        report_period: int = int(devconfig.get('reportperiod', '15'))
+    except ValueError:
+        report_period = 0
+    if report_period not in nscon.REPORT_PERIODS:
+        print(f'ReportPeriod must be one of {", ".join(map(str, nscon.REPORT_PERIODS))} (ms).')
+        os._exit(1)
+    ProCon.ReportSec = nscon.REPORT_PERIODS[report_period]
+
+    if ConfigParser.BOOLEAN_STATES.get(devconfig.get('reportprocess', 'no').lower()):
+        try:
+            report_priority: int = int(devconfig.get('reportpriority', '0'))
+        except ValueError:
+            print(f'ReportPriority must be an integer, got "{devconfig["reportpriority"]}".')
+            os._exit(1)
+        ProCon.reporter = ReportProcess(report_priority,
+                                        devconfig.get('reportcpus'),
+                                        ConfigParser.BOOLEAN_STATES.get(devconfig.get('reportmlock', 'no').lower(), False),
+                                        filters)
+
+    if 'record' in devconfig:
+        if ProCon.reporter != None:
+            print(f'{gadget_path} Record: input reports come from the report process and are '
+                  'not recorded, so the recording cannot be verified.')
+        recorders.append(Recorder(devconfig['record'], ProCon,
+                                  config_ini[devconfig.get('keyconfig', 'KEYCONFIG')]))
+
+    # Mouse and Keyboard take comma separated paths, names or phys. Without
+    # them a single controller falls back to guessing, and the guess is then
+    # pinned by phys so that it survives a reconnect.
+    specs: List[str] = input_specs(devconfig, 'mouse') + input_specs(devconfig, 'keyboard')
+    if specs:
+        for spec in specs:
+            manager.add(spec, ProCon, keymap, ProCon.recorder)
+    elif len(devconfigs) == 1:
+        mouse, keybd = guess_devices()
+        if not mouse or not keybd:
+            print(f'Input Device dose not exists for {gadget_path}. Please check valid device list.')
+            print('Valid Device List')
+            for path in evdev.list_devices():
+                device = InputDevice(path)
+                print(f'\t{device.path} {device.name} {device.phys}')
+            os._exit(1)
+        manager.pin(mouse, ProCon, keymap, ProCon.recorder)
+        manager.pin(keybd, ProCon, keymap, ProCon.recorder)
+    else:
+        print(f'[{devconfig["name"]}] needs Mouse and/or Keyboard.')
+        os._exit(1)
+
+    controllers.append(ProCon)
+    keymaps.append(keymap)
+
+for binding in manager.resolve():
+    print(f'Input device {binding.spec} not found yet for {binding.procon.path}, waiting for it.')
+
+
+def reload_config():
+    # Re-parses config.ini and swaps keymaps, gyro sensitivity and filters of
+    # the running controllers. Nothing is changed unless the whole file is
+    # valid; settings that need a new session are left alone.
+    config: ConfigParser = ConfigParser()
+    try:
+        config.read(config_ini_path, encoding='utf-8')
+        new_devconfigs: List[Dict[str, str]] = read_devconfigs(config)
+        if len(new_devconfigs) != len(controllers):
+            raise ValueError('Adding or removing controllers needs a restart.')
+        settings = [input_settings(config, devconfig, ProCon)
+                    for devconfig, ProCon in zip(new_devconfigs, controllers)]
+    except (configparser.Error, KeyError, ValueError) as e:
+        print(f'config.ini not reloaded: {e}')
+        return
+
+    for devconfig, ProCon, (keymap, dot_per_degree, gyro_filters, filters) in \
+            zip(new_devconfigs, controllers, settings):
+        if ProCon.recorder != None:
+            ProCon.recorder.keyconfig(time.monotonic_ns(), config[devconfig.get('keyconfig', 'KEYCONFIG')])
+        for binding in manager.bindings:
+            if binding.procon is ProCon:
+                binding.batcher.setKeymap(keymap)
+        ProCon.setGyro(dot_per_degree, gyro_filters)
+    print('---- config.ini reloaded. ----')
+
+
+def hand():
+    for ProCon in controllers:
+        ProCon.Disconnect()
+        ProCon.Close()
+        if ProCon.reporter != None:
+            ProCon.reporter.close()
+    for recorder in recorders:
+        recorder.close()
+    engine.stop()
+    watcher.close()
+    if control_server != None:
+        control_server.close()
+    manager.close()
+    if metrics_server != None:
+        metrics_server.close()
+    for gadget in gadgets:
+        try:
+            gadget.reset()
+        except OSError as e:
+            print(f'Cannot reset {gadget.name}: {e}')
+    os._exit(1)
+
 
 loop = asyncio.get_event_loop()
-executor: ThreadPoolExecutor = ThreadPoolExecutor()
-executor.submit(loop.run_forever)
 
-signal.signal(signal.SIGINT, hand)
+for ProCon in controllers:
+    ProCon.startConnect(loop)
+
+# Play: a recording replayed into the controller once the host is connected.
+for devconfig, ProCon, keymap in zip(devconfigs, controllers, keymaps):
+    if 'play' in devconfig:
+        loop.create_task(play(devconfig['play'], ProCon, keymap))
+
+manager.run(loop)
+
+metrics_server = None
+control_server = None
+
+watcher = ConfigWatcher(config_ini_path, reload_config)
+watcher.start(loop)
+
+metrics_server = MetricsServer(controllers,
+                               config_ini.get('METRICS', 'Socket', fallback=None),
+                               config_ini.get('METRICS', 'Textfile', fallback=None))
+loop.run_until_complete(metrics_server.start())
+
+control_socket = config_ini.get('CONTROL', 'Socket', fallback=None)
+control_block = config_ini.get('CONTROL', 'StateBlock', fallback=None)
+if control_socket or control_block:
+    control_server = ControlServer(controllers, control_socket, control_block)
+    try:
+        control_server.start(loop)
+    except OSError as e:
+        print(f'Cannot start control API: {e}')
+        hand()
+
+loop.add_signal_handler(signal.SIGINT, hand)
+loop.run_forever()
@@ -17,6 +17,8 @@ DEVICE_NO="usb0"
 CONFIG_NO="1"
 MAX_POWER="500"
 ATTRIBUTES="0xa0"
+GADGET_NAME="${2:-procon}"          # configfs gadget name
+UDC_NAME="${3:-}"                   # USB device controller, default: the first free one
 
 case "$1" in
     start)
@@ -25,8 +27,8 @@ case "$1" in
 
         echo "Creating gadget directory"
         cd $GADGET
-        mkdir -p procon
-        cd procon
+        mkdir -p $GADGET_NAME
+        cd $GADGET_NAME
 
         echo "Setting ID's"
         echo $VID > idVendor
@@ -60,7 +62,19 @@ case "$1" in
         ln -s functions/hid.$DEVICE_NO configs/c.$CONFIG_NO/
 
         echo "Enabling the USB gadget"
-        ls /sys/class/udc > UDC
+        if [ -z "$UDC_NAME" ]; then
+            for udc in $(ls /sys/class/udc); do
+                if ! cat $GADGET/*/UDC 2>/dev/null | grep -qx "$udc"; then
+                    UDC_NAME=$udc
+                    break
+                fi
+            done
+        fi
+        if [ -z "$UDC_NAME" ]; then
+            echo "No free USB device controller in /sys/class/udc"
+            exit 1
+        fi
+        echo $UDC_NAME > UDC
         echo "OK"
         
         ;;
@@ -68,7 +82,7 @@ case "$1" in
         echo "Stopping the USB gadget"
 
         echo "Disabling the USB gadget"
-        cd $GADGET/procon
+        cd $GADGET/$GADGET_NAME
         echo "" > UDC
 
         echo "Cleaning up"
@@ -84,7 +98,7 @@ case "$1" in
 
         echo "Removing gadget directory"
         cd $GADGET
-        rmdir procon
+        rmdir $GADGET_NAME
         cd /
 
         # modprobe -r libcomposite    # Remove composite module
@@ -92,6 +106,6 @@ case "$1" in
 
         ;;
     *)
-        echo "Usage : $0 {start|stop}"
+        echo "Usage : $0 {start|stop} [gadget name] [udc]"
         ;;
 esac
\ No newline at end of file
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Tuple
+
+import evdev.ecodes as ev
+from evdev import InputEvent
+
+import nscon
+from gyrofilter import compile_filters
+from ingest import EventBatcher
+from keymap import compile_keymap
+
+# Handshake as sent by a Switch after enumeration: 0x80 commands, then UART
+# subcommands (subcommand, argument bytes).
+HOST_HANDSHAKE: List[bytes] = [bytes([0x80, 0x01]), bytes([0x80, 0x02]),
+                               bytes([0x80, 0x03]), bytes([0x80, 0x02])]
+HOST_SUBCOMMANDS: List[bytes] = [
+    bytes([0x02]),
+    bytes([0x08, 0x00]),
+    bytes([0x10, 0x00, 0x60, 0x00, 0x00, 0x10]),
+    bytes([0x10, 0x50, 0x60, 0x00, 0x00, 0x0d]),
+    bytes([0x01, 0x04]),
+    bytes([0x03, 0x30]),
+    bytes([0x04]),
+    bytes([0x10, 0x80, 0x60, 0x00, 0x00, 0x18]),
+    bytes([0x10, 0x98, 0x60, 0x00, 0x00, 0x12]),
+    bytes([0x10, 0x10, 0x80, 0x00, 0x00, 0x18]),
+    bytes([0x10, 0x3d, 0x60, 0x00, 0x00, 0x19]),
+    bytes([0x10, 0x28, 0x80, 0x00, 0x00, 0x18]),
+    bytes([0x10, 0x20, 0x60, 0x00, 0x00, 0x18]),
+    bytes([0x40, 0x01]),
+    bytes([0x48, 0x01]),
+    bytes([0x21, 0x21, 0x00, 0x03]),
+    bytes([0x30, 0x01]),
+    bytes([0x38, 0x01]),
+]
+BENCH_KEYCONFIG: Dict[str, str] = {'KEY_L': 'BUTTON_A', 'BTN_LEFT': 'BUTTON_ZR'}
+BENCH_GYROFILTER: Dict[str, str] = {'Horizontal': 'deadzone 10, accel 0.001 2 3, oneeuro 2.0 0.0001',
+                                    'Vertical': 'ratio 0.8, deadzone 10, ema 0.004'}
+BUTTON_A_BYTE: int = 3
+BUTTON_A_MASK: int = 0x08
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(len(values) * p))]
+    return {'p50': pick(0.50), 'p90': pick(0.90), 'p99': pick(0.99),
+            'max': values[-1], 'count': len(values)}
+
+
+class ScriptedHost:
+    # Plays the console side of the stand-in hidg endpoint.
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.packet = 0
+        self.reportTimes: List[int] = []
+        # (time, state) of every change of button A
+        self.buttonChanges: List[Tuple[int, int]] = []
+        self.lastButton: int = 0
+
+    async def recv(self) -> bytes:
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await loop.sock_recv(self.sock, 128)
+            if data[0] != 0x30:
+                return data
+            self.onReport(data)
+
+    def onReport(self, data: bytes):
+        now: int = time.monotonic_ns()
+        self.reportTimes.append(now)
+        button: int = data[BUTTON_A_BYTE] & BUTTON_A_MASK
+        if button != self.lastButton:
+            self.lastButton = button
+            self.buttonChanges.append((now, 1 if button else 0))
+
+    async def handshake(self) -> float:
+        loop = asyncio.get_running_loop()
+        start: int = time.monotonic_ns()
+        for request in HOST_HANDSHAKE:
+            await loop.sock_sendall(self.sock, request)
+            await self.recv()
+        for subcommand in HOST_SUBCOMMANDS:
+            self.packet = (self.packet + 1) % 16
+            request = bytes([0x01, self.packet]) + bytes(8) + subcommand
+            await loop.sock_sendall(self.sock, request)
+            reply = await self.recv()
+            if reply[0] != 0x21 or reply[14] != subcommand[0]:
+                raise RuntimeError(f'Unexpected reply to {subcommand.hex()}: {reply.hex()}')
+        elapsed: float = (time.monotonic_ns() - start) / 1e6
+        await loop.sock_sendall(self.sock, bytes([0x80, 0x04]))
+        return elapsed
+
+    async def run(self):
+        while True:
+            await self.recv()
+
+
+class SyntheticInput:
+    # Injects mouse motion at a fixed event rate and toggles a mapped key,
+    # going through the same EventBatcher path as a real device.
+    def __init__(self, batcher: EventBatcher, mouseHz: int, keyPeriod: float) -> None:
+        self.batcher = batcher
+        self.mouseHz = mouseHz
+        self.keyPeriod = keyPeriod
+        # (time, state) of every key toggle
+        self.keyTimes: List[Tuple[int, int]] = []
+        self.events: int = 0
+
+    def frame(self, dx: int, dy: int) -> List[InputEvent]:
+        sec, usec = divmod(time.time_ns() // 1000, 1_000_000)
+        return [InputEvent(sec, usec, ev.EV_REL, ev.REL_X, dx),
+                InputEvent(sec, usec, ev.EV_REL, ev.REL_Y, dy),
+                InputEvent(sec, usec, ev.EV_SYN, ev.SYN_REPORT, 0)]
+
+    async def run(self):
+        interval: float = 0.001
+        perTick: int = max(self.mouseHz // 1000, 1)
+        nextKey: float = time.monotonic() + self.keyPeriod
+        pressed: int = 0
+        while True:
+            events: List[InputEvent] = []
+            for i in range(perTick):
+                events += self.frame(1, -1)
+            if time.monotonic() >= nextKey:
+                pressed ^= 1
+                sec, usec = divmod(time.time_ns() // 1000, 1_000_000)
+                events += [InputEvent(sec, usec, ev.EV_KEY, ev.KEY_L, pressed),
+                           InputEvent(sec, usec, ev.EV_SYN, ev.SYN_REPORT, 0)]
+                self.keyTimes.append((time.monotonic_ns(), pressed))
+                nextKey += self.keyPeriod
+            self.batcher.feed(events)
+            self.events += len(events)
+            await asyncio.sleep(interval)
+
+
+def measure_allocations(func, iterations: int = 10000) -> Dict[str, float]:
+    func()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    blocks: int = sys.getallocatedblocks()
+    for i in range(iterations):
+        func()
+    after, peak = tracemalloc.get_traced_memory()
+    leaked: int = sys.getallocatedblocks() - blocks
+    tracemalloc.stop()
+    start: int = time.perf_counter_ns()
+    for i in range(iterations):
+        func()
+    cost: float = (time.perf_counter_ns() - start) / iterations / 1000
+    return {'peak_bytes': peak - before, 'net_bytes': after - before,
+            'net_blocks': leaked, 'us_per_call': cost}
+
+
+def micro_benchmarks(report: float) -> Dict[str, Dict[str, float]]:
+    procon = nscon.Controller(None)
+    procon.ReportSec = report
+    procon.fp = os.open(os.devnull, os.O_WRONLY)
+    procon.stopInput = False
+    keymap = compile_keymap(procon.Input, BENCH_KEYCONFIG)
+    setter = keymap[ev.KEY_L]
+    value: List[int] = [0]
+
+    def toggle_setter():
+        value[0] ^= 1
+        setter(value[0])
+
+    def toggle_set_controller_input():
+        value[0] ^= 1
+        nscon.set_controller_input(procon.Input, 'BUTTON_A', value[0])
+
+    def gyro_report():
+        procon.addGyro(0, 3, -7)
+        procon.InputReport()
+
+    results = {
+        'getInputBuffer': measure_allocations(procon.getInputBuffer),
+        'set_controller_input': measure_allocations(toggle_set_controller_input),
+        'keymap_setter': measure_allocations(toggle_setter),
+        'InputReport': measure_allocations(gyro_report),
+    }
+    procon.gyroFilters = compile_filters(BENCH_GYROFILTER)
+    results['InputReport_filtered'] = measure_allocations(gyro_report)
+    os.close(procon.fp)
+    procon.fp = None
+    return results
+
+
+async def soak(seconds: float, mouseHz: int, report: float) -> Dict[str, object]:
+    loop = asyncio.get_running_loop()
+    gadget, console = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    console.setblocking(False)
+
+    procon = nscon.Controller(None)
+    procon.ReportSec = report
+    keymap = compile_keymap(procon.Input, BENCH_KEYCONFIG)
+    procon.startConnect(loop, fp=gadget.detach())
+
+    host = ScriptedHost(console)
+    handshake: float = await host.handshake()
+    hostTask = asyncio.ensure_future(host.run())
+
+    source = SyntheticInput(EventBatcher(procon, keymap), mouseHz, 0.05)
+    procon.ticker.resetStats()
+    tickerClock: int = time.pthread_getcpuclockid(procon.engine.thread.ident)
+    tickerStart: float = time.clock_gettime(tickerClock)
+    cpuStart: float = time.process_time()
+    sourceTask = asyncio.ensure_future(source.run())
+    await asyncio.sleep(seconds)
+    tickerCpu: float = time.clock_gettime(tickerClock) - tickerStart
+    cpu: float = time.process_time() - cpuStart
+    sourceTask.cancel()
+    hostTask.cancel()
+    tickerStats = procon.ticker.stats()
+    procon.Close()
+    console.close()
+
+    intervals: List[float] = [(b - a) / 1000 for a, b in zip(host.reportTimes, host.reportTimes[1:])]
+    jitter: List[float] = [abs(i - report * 1e6) for i in intervals]
+    # A toggle pairs with the next change to the same state; a toggle that
+    # never showed up (pressed and released within one report) is skipped
+    # without consuming a change, so the later pairs stay aligned.
+    latency: List[float] = []
+    changes: List[Tuple[int, int]] = host.buttonChanges
+    index: int = 0
+    for pressed, state in source.keyTimes:
+        while index < len(changes) and changes[index][0] < pressed:
+            index += 1
+        if index < len(changes) and changes[index][1] == state:
+            latency.append((changes[index][0] - pressed) / 1000)
+            index += 1
+
+    reports: int = max(len(host.reportTimes), 1)
+    return {
+        'handshake_ms': handshake,
+        'reports': len(host.reportTimes),
+        'report_rate_hz': len(host.reportTimes) / seconds,
+        # report thread only, without the synthetic input and scripted host
+        'ticker_cpu_per_report_us': tickerCpu / reports * 1e6,
+        # whole process, including the synthetic input and scripted host
+        'process_cpu_percent': cpu / seconds * 100,
+        'evdev_events': source.events,
+        'report_interval_us': percentiles(intervals),
+        'report_jitter_us': percentiles(jitter),
+        'evdev_to_hid_latency_us': percentiles(latency),
+        'ticker': tickerStats,
+        'counters': dict(procon.metrics.counters),
+    }
+
+
+def print_results(results: Dict[str, object], indent: str = ''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            print(f'{indent}{key}:')
+            print_results(value, indent + '    ')
+        elif isinstance(value, float):
+            print(f'{indent}{key}: {value:.2f}')
+        else:
+            print(f'{indent}{key}: {value}')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Hardware-free benchmark and soak test for nscon.Controller')
+    parser.add_argument('--seconds', type=float, default=10.0, help='soak duration')
+    parser.add_argument('--mouse-hz', type=int, default=1000, help='synthetic mouse event rate')
+    parser.add_argument('--report-ms', type=float, default=15.0, help='input report period')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(argv[1:])
+
+    report: float = args.report_ms / 1000
+    results = {
+        'micro': micro_benchmarks(report),
+        'soak': asyncio.run(soak(args.seconds, args.mouse_hz, report)),
+    }
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import sys
+import threading
+import time
+from typing import Iterator, Tuple
+
+# Packet direction as seen from the controller.
+HOST_TO_DEVICE: int = 0
+DEVICE_TO_HOST: int = 1
+
+CAPTURE_MAGIC: bytes = b'NSPCCAP1'
+PAYLOAD_SIZE: int = 64
+# monotonic ns, direction, payload length, padding, payload
+RECORD: struct.Struct = struct.Struct('<QBB6x64s')
+
+
+class CaptureWriter:
+    # Fixed size records are packed into a preallocated ring on the relay
+    # thread; a background thread flushes completed slots to the file so the
+    # relay never blocks on disk I/O. Records are dropped (and counted) only
+    # when the ring is full.
+    slots: int
+    flushSec: float
+    head: int = 0
+    tail: int = 0
+    dropped: int = 0
+
+    def __init__(self, path: str, slots: int = 4096, flushSec: float = 0.1) -> None:
+        self.slots = slots
+        self.flushSec = flushSec
+        self.ring = bytearray(slots * RECORD.size)
+        self.view = memoryview(self.ring)
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.write(self.fd, CAPTURE_MAGIC)
+
+        self.stopWriter = False
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='CaptureWriter', daemon=True)
+        self.thread.start()
+
+    def append(self, direction: int, data: bytes):
+        if self.head - self.tail >= self.slots:
+            self.dropped += 1
+            return
+
+        RECORD.pack_into(self.ring, (self.head % self.slots) * RECORD.size,
+                         time.monotonic_ns(), direction, min(len(data), PAYLOAD_SIZE), data)
+        self.head += 1
+        if self.head - self.tail >= self.slots // 2:
+            self.wakeup.set()
+
+    def run(self):
+        while not self.stopWriter:
+            self.wakeup.wait(self.flushSec)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        head: int = self.head
+        while self.tail < head:
+            start: int = self.tail % self.slots
+            end: int = min(self.slots, start + head - self.tail)
+            os.write(self.fd, self.view[start * RECORD.size:end * RECORD.size])
+            self.tail += end - start
+
+    def close(self):
+        self.stopWriter = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        os.close(self.fd)
+
+
+def read_capture(path: str) -> Iterator[Tuple[int, int, bytes]]:
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f'{path} is not a ProCon capture file')
+        while True:
+            record = f.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return
+            timestamp, direction, length, payload = RECORD.unpack(record)
+            yield timestamp, direction, payload[:length]
+
+
+def describe(direction: int, data: bytes) -> str:
+    if not data:
+        return 'Empty packet'
+
+    if direction == HOST_TO_DEVICE:
+        if data[0] == 0x80:
+            if data[1] == 0x01:
+                return 'Request Mac Address'
+            elif data[1] in [0x02, 0x03]:
+                return 'Handshake'
+            elif data[1] == 0x04:
+                return 'Enable USB HID Joystick report'
+        elif data[0] == 0x01 and len(data) > 15:
+            if data[10] == 0x01:
+                return 'Bluetooth manual pairing'
+            elif data[10] == 0x02:
+                return 'Request device info'
+            elif data[10] in [0x03, 0x08, 0x30, 0x38, 0x40, 0x41, 0x48]:
+                return 'Nazo'
+            elif data[10] == 0x04:
+                return 'Trigger buttons elapsed time'
+            elif data[10] == 0x10:
+                return f'Read SPI address: {data[12]:02x}{data[11]:02x}[{data[15]}]'
+            elif data[10] == 0x21:
+                return 'Set NFC/IR MCU configuration'
+            return f'UART unknown request {data[10]}'
+    else:
+        if data[0] == 0x30:
+            return 'Input report'
+        elif data[0] == 0x21 and len(data) > 20 and data[14] == 0x10:
+            length: int = data[19]
+            return f'SPI data {data[16]:02x}{data[15]:02x}[{length}] {data[20:20 + length].hex()}'
+        elif data[0] == 0x21:
+            return f'UART reply {data[14]:02x} ack {data[13]:02x}'
+        elif data[0] == 0x81:
+            return f'Handshake reply {data[1]:02x}'
+
+    return data.hex()
+
+
+def main(argv):
+    if len(argv) < 2:
+        print(f'Usage: {argv[0]} CAPTURE_FILE [--all]')
+        return 1
+
+    showAll: bool = '--all' in argv[2:]
+    start: int = None
+    for timestamp, direction, data in read_capture(argv[1]):
+        if start is None:
+            start = timestamp
+        if direction == DEVICE_TO_HOST and data[:1] == b'\x30' and not showAll:
+            continue
+        arrow: str = '>>>' if direction == HOST_TO_DEVICE else '<<<'
+        print(f'{(timestamp - start) / 1e6:12.3f} {arrow} {describe(direction, data)}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
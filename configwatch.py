@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+from typing import Callable, Optional
+
+from inotify import IN_CLOSE_WRITE, IN_MOVED_TO, Inotify
+
+
+class ConfigWatcher:
+    # Calls reload() after the file was rewritten in place or replaced by a
+    # rename, which is what most editors do. The directory is watched rather
+    # than the file so a replaced file keeps being watched; bursts of events
+    # from one save are folded into a single reload.
+    def __init__(self, path: str, reload: Callable[[], None], delay: float = 0.05) -> None:
+        self.path = os.path.abspath(path)
+        self.name: str = os.path.basename(self.path)
+        self.reload = reload
+        self.delay = delay
+        self.loop: asyncio.AbstractEventLoop = None
+        self.inotify: Optional[Inotify] = None
+        self.pending: Optional[asyncio.TimerHandle] = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        try:
+            self.inotify = Inotify()
+            self.inotify.watch(os.path.dirname(self.path), IN_CLOSE_WRITE | IN_MOVED_TO)
+        except OSError as e:
+            print(f'Config reload disabled: {e}')
+            self.inotify = None
+            return
+        loop.add_reader(self.inotify.fd, self.onInotify)
+
+    def onInotify(self):
+        if not any(name == self.name for _, _, name in self.inotify.read()):
+            return
+        if self.pending is not None:
+            self.pending.cancel()
+        self.pending = self.loop.call_later(self.delay, self.fire)
+
+    def fire(self):
+        self.pending = None
+        self.reload()
+
+    def close(self):
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+        if self.inotify is not None:
+            self.loop.remove_reader(self.inotify.fd)
+            self.inotify.close()
+            self.inotify = None
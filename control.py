@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+import asyncio
+import mmap
+import os
+import socket
+import struct
+import time
+from typing import List, Optional, Tuple
+
+import nscon
+
+# Datagram: header followed by count fixed size commands.
+# magic, controller index, command count
+HEADER: struct.Struct = struct.Struct('<2sBB')
+CONTROL_MAGIC: bytes = b'NC'
+# op, arg, a, b, c
+COMMAND: struct.Struct = struct.Struct('<BBhhh')
+MAX_COMMANDS: int = 255
+DATAGRAM_SIZE: int = HEADER.size + COMMAND.size * MAX_COMMANDS
+
+OP_BUTTON: int = 1      # arg: bit (nscon.REPORT_BUTTONS), a: pressed
+OP_BUTTONS: int = 2     # a: bits 0..15, b: bits 16..23 of the whole button field
+OP_STICK: int = 3       # arg: 0 left / 1 right, a: X, b: Y (0..4095, centre 2048)
+OP_GYRO: int = 4        # a, b, c: gyro x, y, z motion in mouse dots
+
+# Optional shared state block, one slot per controller. Clients write it
+# seqlock style: make seq odd, update the fields, make it even again.
+# seq, buttons, lx, ly, rx, ry, cumulative gyro x, y, z in dots
+STATE_SLOT: struct.Struct = struct.Struct('<IIHHHHddd')
+STATE_SLOT_SIZE: int = 64
+
+
+class ControlTarget:
+    # Applies control commands to one controller through the same
+    # ControllerInput fields the keymap uses, so the report frame (or the
+    # report process) picks them up with the next 0x30 report.
+    def __init__(self, procon: nscon.Controller) -> None:
+        self.procon = procon
+        self.buttons: List[Tuple[object, str, int]] = []
+        for member, attr, bit in nscon.REPORT_BUTTONS.values():
+            target = procon.Input
+            for name in member.split('.'):
+                target = getattr(target, name)
+            self.buttons.append((target, attr, bit))
+        self.byBit = {bit: (target, attr) for target, attr, bit in self.buttons}
+        self.sticks = [procon.Input.Stick.Left, procon.Input.Stick.Right]
+        self.state: Optional[Tuple] = None
+
+    def button(self, bit: int, pressed: int) -> bool:
+        target = self.byBit.get(bit)
+        if target is None:
+            return False
+        setattr(target[0], target[1], 1 if pressed else 0)
+        return True
+
+    def setButtons(self, field: int):
+        for target, attr, bit in self.buttons:
+            setattr(target, attr, (field >> bit) & 1)
+
+    def stick(self, index: int, x: int, y: int) -> bool:
+        if index > 1:
+            return False
+        stick = self.sticks[index]
+        stick.X = min(max(x, 0), 0xFFF)
+        stick.Y = min(max(y, 0), 0xFFF)
+        return True
+
+    def apply(self, op: int, arg: int, a: int, b: int, c: int, now: int) -> bool:
+        if op == OP_BUTTON:
+            return self.button(arg, a)
+        if op == OP_BUTTONS:
+            self.setButtons((a & 0xFFFF) | ((b & 0xFF) << 16))
+            return True
+        if op == OP_STICK:
+            return self.stick(arg, a, b)
+        if op == OP_GYRO:
+            self.procon.addGyro(a, b, c, now)
+            return True
+        return False
+
+    def command(self, op: int, arg: int, a, b, c, now: int) -> bool:
+        # apply() and, if the controller is recorded, record it.
+        if not self.apply(op, arg, a, b, c, now):
+            return False
+        recorder = self.procon.recorder
+        if recorder != None:
+            recorder.control(now, op, arg, a, b, c)
+        return True
+
+    def applyState(self, state: Tuple, now: int):
+        # State block slot: only what changed since the last snapshot.
+        seq, buttons, lx, ly, rx, ry, gx, gy, gz = state
+        last = self.state
+        if last is None or buttons != last[1]:
+            self.command(OP_BUTTONS, 0, buttons & 0xFFFF, (buttons >> 16) & 0xFF, 0, now)
+        if last is None or (lx, ly) != last[2:4]:
+            self.command(OP_STICK, 0, lx, ly, 0, now)
+        if last is None or (rx, ry) != last[4:6]:
+            self.command(OP_STICK, 1, rx, ry, 0, now)
+        if last is not None and (gx, gy, gz) != last[6:9]:
+            self.command(OP_GYRO, 0, gx - last[6], gy - last[7], gz - last[8], now)
+        self.state = state
+        self.procon.markInput(now)
+
+
+class ControlServer:
+    # Local control surface for automation: any number of clients send
+    # fixed layout binary datagrams to one Unix socket, and/or write a
+    # memory mapped state block that is polled twice per report period.
+    # Nothing is parsed as text and no reply is sent.
+    def __init__(self, controllers: List[nscon.Controller], socketPath: str = None,
+                 statePath: str = None) -> None:
+        self.targets: List[ControlTarget] = [ControlTarget(procon) for procon in controllers]
+        self.socketPath = socketPath
+        self.statePath = statePath
+        self.loop: asyncio.AbstractEventLoop = None
+        self.sock: Optional[socket.socket] = None
+        self.buf = bytearray(DATAGRAM_SIZE)
+        self.block: Optional[mmap.mmap] = None
+        self.seqs: List[int] = [0] * len(controllers)
+        self.pollSec: float = min(procon.ReportSec for procon in controllers) / 2
+        self.poller: Optional[asyncio.TimerHandle] = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        if self.socketPath:
+            if os.path.exists(self.socketPath):
+                os.unlink(self.socketPath)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.bind(self.socketPath)
+            self.sock.setblocking(False)
+            loop.add_reader(self.sock.fileno(), self.receive)
+
+        if self.statePath:
+            size: int = STATE_SLOT_SIZE * len(self.targets)
+            fd: int = os.open(self.statePath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o660)
+            try:
+                os.ftruncate(fd, size)
+                self.block = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            self.poller = loop.call_later(self.pollSec, self.poll)
+
+    def receive(self):
+        buf = self.buf
+        while True:
+            try:
+                size: int = self.sock.recv_into(buf)
+            except BlockingIOError:
+                return
+            self.handle(size, time.monotonic_ns())
+
+    def handle(self, size: int, now: int):
+        buf = self.buf
+        if size < HEADER.size:
+            self.targets[0].procon.metrics.count('control_rejected')
+            return
+        magic, index, count = HEADER.unpack_from(buf, 0)
+        if magic != CONTROL_MAGIC or index >= len(self.targets) \
+                or size != HEADER.size + count * COMMAND.size:
+            self.targets[0].procon.metrics.count('control_rejected')
+            return
+
+        target: ControlTarget = self.targets[index]
+        metrics = target.procon.metrics
+        offset: int = HEADER.size
+        for _ in range(count):
+            if target.command(*COMMAND.unpack_from(buf, offset), now):
+                metrics.count('control_commands')
+            else:
+                metrics.count('control_rejected')
+            offset += COMMAND.size
+        target.procon.markInput(now)
+
+    def poll(self):
+        block = self.block
+        now: int = time.monotonic_ns()
+        for index, target in enumerate(self.targets):
+            offset: int = index * STATE_SLOT_SIZE
+            seq: int = STATE_SLOT.unpack_from(block, offset)[0]
+            if seq & 1 or seq == self.seqs[index]:
+                continue
+            state = STATE_SLOT.unpack_from(block, offset)
+            if STATE_SLOT.unpack_from(block, offset)[0] != seq:
+                continue
+            self.seqs[index] = seq
+            target.applyState(state, now)
+            target.procon.metrics.count('control_commands')
+        self.poller = self.loop.call_later(self.pollSec, self.poll)
+
+    def close(self):
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.socketPath):
+                os.unlink(self.socketPath)
+        if self.poller is not None:
+            self.poller.cancel()
+            self.poller = None
+        if self.block is not None:
+            self.block.close()
+            self.block = None
+
+
+class ControlClient:
+    # Batches commands for one controller into a single datagram.
+    def __init__(self, socketPath: str, controller: int = 0) -> None:
+        self.socketPath = socketPath
+        self.controller = controller
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.commands: List[bytes] = []
+
+    def button(self, name: str, pressed: bool):
+        self.commands.append(COMMAND.pack(OP_BUTTON, nscon.REPORT_BUTTONS[name][2], int(pressed), 0, 0))
+
+    def buttons(self, field: int):
+        self.commands.append(COMMAND.pack(OP_BUTTONS, 0, struct.unpack('<h', struct.pack('<H', field & 0xFFFF))[0],
+                                          (field >> 16) & 0xFF, 0))
+
+    def stick(self, index: int, x: int, y: int):
+        self.commands.append(COMMAND.pack(OP_STICK, index, x, y, 0))
+
+    def gyro(self, x: int, y: int, z: int):
+        self.commands.append(COMMAND.pack(OP_GYRO, 0, x, y, z))
+
+    def send(self):
+        while self.commands:
+            batch: List[bytes] = self.commands[:MAX_COMMANDS]
+            del self.commands[:MAX_COMMANDS]
+            self.sock.sendto(HEADER.pack(CONTROL_MAGIC, self.controller, len(batch)) + b''.join(batch),
+                             self.socketPath)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+from typing import Dict, List
+
+import numpy as np
+
+import nscon
+from capture import CAPTURE_MAGIC, DEVICE_TO_HOST, HOST_TO_DEVICE, PAYLOAD_SIZE, RECORD
+
+# capture.RECORD as a NumPy record, so a capture file maps straight into an
+# array without touching individual packets in Python.
+CAPTURE_DTYPE: np.dtype = np.dtype([
+    ('timestamp', '<u8'),
+    ('direction', 'u1'),
+    ('length', 'u1'),
+    ('padding', 'V6'),
+    ('data', 'u1', (PAYLOAD_SIZE,)),
+])
+assert CAPTURE_DTYPE.itemsize == RECORD.size
+
+REPORT_DTYPE: np.dtype = np.dtype([
+    ('timestamp', '<u8'),
+    ('counter', 'u1'),
+    ('buttons', '<u4'),
+    ('lx', '<u2'), ('ly', '<u2'),
+    ('rx', '<u2'), ('ry', '<u2'),
+    # three IMU samples of x, y, z
+    ('accel', '<i2', (nscon.SENSOR_SAMPLES, 3)),
+    ('gyro', '<i2', (nscon.SENSOR_SAMPLES, 3)),
+])
+
+REQUEST_DTYPE: np.dtype = np.dtype([
+    ('timestamp', '<u8'),
+    ('command', 'u1'),
+    ('subcommand', 'u1'),
+    ('address', '<u4'),
+    ('length', 'u1'),
+])
+
+# button name -> bit in REPORT_DTYPE buttons (bytes 3..5 of the report)
+BUTTONS: Dict[str, int] = {name: bit for name, (member, attr, bit) in nscon.REPORT_BUTTONS.items()}
+
+GYRO_DPS: float = 0.07
+
+
+def load(path: str) -> np.ndarray:
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f'{path} is not a ProCon capture file')
+        f.seek(0, 2)
+        count: int = (f.tell() - len(CAPTURE_MAGIC)) // CAPTURE_DTYPE.itemsize
+    if count == 0:
+        return np.zeros(0, CAPTURE_DTYPE)
+    return np.memmap(path, CAPTURE_DTYPE, 'r', len(CAPTURE_MAGIC), (count,))
+
+
+def sticks(data: np.ndarray, offset: int):
+    # Two 12 bit values packed little endian into 3 bytes.
+    b0 = data[:, offset].astype(np.uint16)
+    b1 = data[:, offset + 1].astype(np.uint16)
+    b2 = data[:, offset + 2].astype(np.uint16)
+    return b0 | ((b1 & 0x0F) << 8), (b1 >> 4) | (b2 << 4)
+
+
+def input_reports(records: np.ndarray) -> np.ndarray:
+    data = records['data']
+    mask = (records['direction'] == DEVICE_TO_HOST) & (data[:, 0] == 0x30)
+    data = data[mask]
+
+    reports = np.zeros(len(data), REPORT_DTYPE)
+    reports['timestamp'] = records['timestamp'][mask]
+    reports['counter'] = data[:, 1]
+    reports['buttons'] = (data[:, 3].astype(np.uint32) | (data[:, 4].astype(np.uint32) << 8)
+                          | (data[:, 5].astype(np.uint32) << 16))
+    reports['lx'], reports['ly'] = sticks(data, nscon.LSTICK_OFFSET)
+    reports['rx'], reports['ry'] = sticks(data, nscon.RSTICK_OFFSET)
+
+    end: int = nscon.SENSOR_OFFSET + nscon.IMU_SAMPLE.size * nscon.SENSOR_SAMPLES
+    imu = np.ascontiguousarray(data[:, nscon.SENSOR_OFFSET:end]).view('<i2')
+    imu = imu.reshape(len(data), nscon.SENSOR_SAMPLES, 6)
+    reports['accel'] = imu[:, :, 0:3]
+    reports['gyro'] = imu[:, :, 3:6]
+    return reports
+
+
+def requests(records: np.ndarray) -> np.ndarray:
+    # Host to controller traffic: 0x80 handshake commands and 0x01 UART
+    # subcommands with their SPI address and length.
+    data = records['data']
+    mask = (records['direction'] == HOST_TO_DEVICE) & np.isin(data[:, 0], [0x80, 0x01])
+    data = data[mask]
+    uart = data[:, 0] == 0x01
+
+    result = np.zeros(len(data), REQUEST_DTYPE)
+    result['timestamp'] = records['timestamp'][mask]
+    result['command'] = data[:, 0]
+    result['subcommand'] = np.where(uart, data[:, 10], data[:, 1])
+    address = np.ascontiguousarray(data[:, 11:15]).view('<u4')[:, 0]
+    result['address'] = np.where(uart, address, 0)
+    result['length'] = np.where(uart, data[:, 15], 0)
+    return result
+
+
+def button(reports: np.ndarray, name: str) -> np.ndarray:
+    return ((reports['buttons'] >> BUTTONS[name]) & 1).astype(bool)
+
+
+def series(reports: np.ndarray) -> Dict[str, np.ndarray]:
+    # Per field time series, one value per IMU sample for the sensors.
+    start = reports['timestamp'][0] if len(reports) else 0
+    columns: Dict[str, np.ndarray] = {
+        'time_s': (reports['timestamp'] - start) / 1e9,
+        'counter': reports['counter'],
+        'lx': reports['lx'], 'ly': reports['ly'],
+        'rx': reports['rx'], 'ry': reports['ry'],
+    }
+    for name in BUTTONS:
+        columns[name] = button(reports, name)
+    for sensor in ['accel', 'gyro']:
+        for i in range(nscon.SENSOR_SAMPLES):
+            for j, axis in enumerate('xyz'):
+                columns[f'{sensor}{i}_{axis}'] = reports[sensor][:, i, j]
+    return columns
+
+
+def summarize(records: np.ndarray) -> Dict[str, object]:
+    reports = input_reports(records)
+    reqs = requests(records)
+    summary: Dict[str, object] = {
+        'packets': len(records),
+        'input_reports': len(reports),
+        'requests': len(reqs),
+    }
+    if len(records):
+        summary['duration_s'] = float(records['timestamp'][-1] - records['timestamp'][0]) / 1e9
+
+    if len(reqs):
+        kinds, counts = np.unique((reqs['command'].astype(np.uint16) << 8) | reqs['subcommand'],
+                                  return_counts=True)
+        summary['request_counts'] = {f'{kind >> 8:02x}:{kind & 0xFF:02x}': int(count)
+                                     for kind, count in zip(kinds, counts)}
+        spi = reqs[(reqs['command'] == 0x01) & (reqs['subcommand'] == 0x10)]
+        if len(spi):
+            reads, counts = np.unique((spi['address'].astype(np.uint64) << 8) | spi['length'],
+                                      return_counts=True)
+            summary['spi_reads'] = {f'{read >> 8:05x}[{read & 0xFF}]': int(count)
+                                    for read, count in zip(reads, counts)}
+
+    if len(reports) > 1:
+        intervals = np.diff(reports['timestamp'].astype(np.int64)) / 1e3
+        summary['report_interval_us'] = {
+            'mean': float(intervals.mean()),
+            'p50': float(np.percentile(intervals, 50)),
+            'p99': float(np.percentile(intervals, 99)),
+            'max': float(intervals.max()),
+        }
+        steps = np.diff(reports['counter'].astype(np.int16)) % 256
+        summary['counter_step'] = {'mean': float(steps.mean()), 'max': int(steps.max())}
+
+        bits = (reports['buttons'][:, None] >> np.array(list(BUTTONS.values()), np.uint32)) & 1
+        presses = np.count_nonzero(np.diff(bits.astype(np.int8), axis=0) == 1, axis=0)
+        summary['presses'] = {name: int(count) for name, count in zip(BUTTONS, presses) if count}
+
+        summary['sticks'] = {field: {'mean': float(reports[field].mean()),
+                                     'min': int(reports[field].min()),
+                                     'max': int(reports[field].max())}
+                             for field in ['lx', 'ly', 'rx', 'ry']}
+
+        dps = reports['gyro'].reshape(-1, 3) * GYRO_DPS
+        summary['gyro_dps'] = {axis: {'mean': float(dps[:, i].mean()),
+                                      'std': float(dps[:, i].std()),
+                                      'max_abs': float(np.abs(dps[:, i]).max())}
+                               for i, axis in enumerate('xyz')}
+    return summary
+
+
+def print_summary(summary: Dict[str, object], indent: str = ''):
+    for key, value in summary.items():
+        if isinstance(value, dict):
+            print(f'{indent}{key}:')
+            print_summary(value, indent + '    ')
+        elif isinstance(value, float):
+            print(f'{indent}{key}: {value:.3f}')
+        else:
+            print(f'{indent}{key}: {value}')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Bulk decode ProCon capture files')
+    parser.add_argument('capture')
+    parser.add_argument('--csv', help='write the input report time series to a CSV file')
+    parser.add_argument('--npz', help='write the decoded arrays to a NumPy .npz file')
+    args = parser.parse_args(argv[1:])
+
+    records = load(args.capture)
+    print_summary(summarize(records))
+
+    if args.csv or args.npz:
+        columns = series(input_reports(records))
+        if args.csv:
+            names: List[str] = list(columns)
+            table = np.column_stack([columns[name].astype(np.float64) for name in names])
+            np.savetxt(args.csv, table, fmt='%.9g', delimiter=',', header=','.join(names), comments='')
+        if args.npz:
+            np.savez(args.npz, reports=input_reports(records), requests=requests(records), **columns)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
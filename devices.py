@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+from typing import Dict, List, Optional, Tuple
+
+import evdev
+import evdev.ecodes as ev
+from evdev import InputDevice
+
+from ingest import EventBatcher, attach
+from inotify import IN_ATTRIB, IN_CREATE, IN_DELETE, Inotify
+from keymap import KeyMap
+from nscon import Controller
+
+INPUT_DIR: str = '/dev/input'
+SYSFS_INPUT: str = '/sys/class/input'
+
+
+def describe(path: str) -> Tuple[str, str]:
+    # Name and phys of an event node from sysfs, without opening the device.
+    node: str = os.path.join(SYSFS_INPUT, os.path.basename(path), 'device')
+    info: List[str] = []
+    for attr in ['name', 'phys']:
+        try:
+            with open(os.path.join(node, attr)) as f:
+                info.append(f.read().strip())
+        except OSError:
+            info.append('')
+    return info[0], info[1]
+
+
+def event_nodes() -> List[str]:
+    try:
+        names: List[str] = os.listdir(INPUT_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(os.path.join(INPUT_DIR, name) for name in names if name.startswith('event'))
+
+
+def guess_devices() -> Tuple[Optional[InputDevice], Optional[InputDevice]]:
+    # Full scan: opens every device and picks a mouse and a keyboard by their
+    # capabilities. Only used when config.ini does not name the devices.
+    mouse = None
+    keybd = None
+
+    for path in evdev.list_devices():
+        dev = InputDevice(path)
+        devcapa = dev.capabilities()
+        ecREL = ev.ecodes['EV_REL']
+        ecKEY = ev.ecodes['EV_KEY']
+        ecBTNMOUSE = ev.ecodes['BTN_MOUSE']
+        if (ecREL in devcapa) and (ecBTNMOUSE in devcapa[ecKEY]):
+            mouse = dev
+        elif (ecREL not in devcapa) and (ecKEY in devcapa):
+            keybd = dev
+
+    return mouse, keybd
+
+
+class Binding:
+    # One configured input device of a controller. The path it was last
+    # found at is remembered, so a re-plugged device is usually matched
+    # without looking at any other node.
+    device: Optional[InputDevice] = None
+    path: Optional[str] = None
+
+    def __init__(self, spec: str, procon: Controller, keymap: KeyMap,
+                 recorder=None, index: int = 0) -> None:
+        self.spec = spec
+        self.procon = procon
+        self.batcher = EventBatcher(procon, keymap, recorder, index)
+
+    def matches(self, path: str, name: str, phys: str) -> bool:
+        spec: str = self.spec
+        return spec in (path, name, phys) or os.path.realpath(spec) == path
+
+
+class DeviceManager:
+    # Keeps every Binding attached to a matching evdev device. Devices are
+    # looked up by path, name or phys through sysfs, and /dev/input is
+    # watched so that unplugged devices are re-attached as soon as they come
+    # back. Any number of devices may drive the same controller; each gets
+    # its own EventBatcher and their input is merged into the controller.
+    def __init__(self) -> None:
+        self.bindings: List[Binding] = []
+        self.attached: Dict[str, Binding] = {}
+        self.loop: asyncio.AbstractEventLoop = None
+        self.inotify: Optional[Inotify] = None
+
+    def add(self, spec: str, procon: Controller, keymap: KeyMap, recorder=None) -> Binding:
+        index: int = sum(1 for binding in self.bindings if binding.procon is procon)
+        binding = Binding(spec, procon, keymap, recorder, index)
+        self.bindings.append(binding)
+        return binding
+
+    def pin(self, device: InputDevice, procon: Controller, keymap: KeyMap, recorder=None) -> Binding:
+        # Binds an already opened device, e.g. one found by guess_devices().
+        binding = self.add(device.phys or device.path, procon, keymap, recorder)
+        binding.device = device
+        binding.path = device.path
+        return binding
+
+    def resolve(self) -> List[Binding]:
+        # Opens the devices of all unattached bindings. Returns the bindings
+        # that are still missing.
+        for binding in self.bindings:
+            if binding.device is None and binding.path is not None:
+                self.probe(binding.path, [binding])
+
+        missing: List[Binding] = [b for b in self.bindings if b.device is None]
+        if missing:
+            for path in event_nodes():
+                if path not in self.attached:
+                    self.probe(path, missing)
+            missing = [b for b in self.bindings if b.device is None]
+        return missing
+
+    def probe(self, path: str, bindings: List[Binding]) -> Optional[Binding]:
+        if path in self.attached:
+            return None
+        name, phys = describe(path)
+        for binding in bindings:
+            if binding.device is None and binding.matches(path, name, phys):
+                try:
+                    binding.device = InputDevice(path)
+                except OSError:
+                    # udev may not have set the permissions yet; IN_ATTRIB
+                    # brings us back here.
+                    return None
+                binding.path = path
+                self.attached[path] = binding
+                if self.loop is not None:
+                    self.start(binding)
+                return binding
+        return None
+
+    def start(self, binding: Binding):
+        device: InputDevice = binding.device
+        print(f'Input device attached: {device.path} {device.name}')
+        attach(self.loop, device, binding.batcher, lambda dev: self.lost(binding))
+
+    def lost(self, binding: Binding):
+        device: InputDevice = binding.device
+        self.attached.pop(binding.path, None)
+        binding.device = None
+        try:
+            device.close()
+        except OSError:
+            pass
+
+    def run(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        for binding in self.bindings:
+            if binding.device is not None:
+                self.attached[binding.path] = binding
+                self.start(binding)
+
+        try:
+            self.inotify = Inotify()
+            self.inotify.watch(INPUT_DIR, IN_CREATE | IN_ATTRIB | IN_DELETE)
+        except OSError as e:
+            print(f'Input hot-plug disabled: {e}')
+            return
+        loop.add_reader(self.inotify.fd, self.onInotify)
+
+    def onInotify(self):
+        for directory, mask, name in self.inotify.read():
+            if not name.startswith('event') or mask & IN_DELETE:
+                continue
+            path: str = os.path.join(directory, name)
+            # The cached path of a binding is tried first.
+            self.probe(path, sorted(self.bindings, key=lambda b: b.path != path))
+
+    def close(self):
+        if self.inotify is not None:
+            self.loop.remove_reader(self.inotify.fd)
+            self.inotify.close()
+            self.inotify = None
+        for binding in self.bindings:
+            if binding.device is not None:
+                if self.loop is not None:
+                    self.loop.remove_reader(binding.device.fd)
+                binding.device.close()
+                binding.device = None
+        self.attached.clear()
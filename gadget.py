@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import os
+import select
+import time
+from typing import Optional, Set
+
+from inotify import IN_ATTRIB, IN_CREATE, Inotify
+
+CONFIGFS_GADGETS: str = '/sys/kernel/config/usb_gadget'
+UDC_CLASS: str = '/sys/class/udc'
+
+
+class Gadget:
+    # configfs USB gadget lifecycle: binds and unbinds it by writing its UDC
+    # attribute directly, and waits for the hidg node and the host with
+    # inotify/poll instead of fixed sleeps.
+    enabledAt: int = 0
+    udc: Optional[str] = None
+
+    def __init__(self, name: str = 'procon', udc: str = None, device: str = '/dev/hidg0') -> None:
+        self.name = name
+        self.path: str = os.path.join(CONFIGFS_GADGETS, name)
+        self.device = device
+        self.udc = udc
+
+    def exists(self) -> bool:
+        return os.path.isdir(self.path)
+
+    def boundUdc(self) -> str:
+        with open(os.path.join(self.path, 'UDC')) as f:
+            return f.read().strip()
+
+    def writeUdc(self, value: str):
+        with open(os.path.join(self.path, 'UDC'), 'w') as f:
+            f.write(value + '\n')
+
+    def disable(self):
+        # Unbinding a gadget that is not bound fails with ENODEV.
+        if self.boundUdc():
+            self.writeUdc('')
+
+    def enable(self):
+        udc: Optional[str] = self.udc
+        if udc is None:
+            # The first controller no other gadget is bound to.
+            udcs = [udc for udc in sorted(os.listdir(UDC_CLASS)) if udc not in boundUdcs(self.name)]
+            if not udcs:
+                raise FileNotFoundError(f'No free USB device controller in {UDC_CLASS}')
+            udc = udcs[0]
+        self.writeUdc(udc)
+        self.enabledAt = time.monotonic_ns()
+        self.udc = udc
+
+    def reset(self):
+        self.disable()
+        self.enable()
+
+    def waitDevice(self, timeout: float = 5.0) -> bool:
+        # The hidg node is (re)created when the gadget is bound; watch its
+        # directory so we return as soon as it is there and accessible.
+        deadline: float = time.monotonic() + timeout
+        inotify = Inotify()
+        try:
+            inotify.watch(os.path.dirname(self.device), IN_CREATE | IN_ATTRIB)
+            while not os.access(self.device, os.R_OK | os.W_OK):
+                remaining: float = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                select.select([inotify.fd], [], [], remaining)
+                inotify.read()
+            return True
+        finally:
+            inotify.close()
+
+    def waitConfigured(self, timeout: float = 5.0) -> bool:
+        # The UDC state attribute is sysfs_notify()ed on every change, which
+        # poll() reports as POLLPRI. Re-check periodically in case it is not.
+        deadline: float = time.monotonic() + timeout
+        try:
+            f = open(os.path.join(UDC_CLASS, self.udc, 'state'), 'rb', buffering=0)
+        except (OSError, TypeError):
+            return False
+        with f:
+            poller = select.poll()
+            poller.register(f, select.POLLPRI | select.POLLERR)
+            while True:
+                f.seek(0)
+                if f.read().strip() == b'configured':
+                    return True
+                remaining: float = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                poller.poll(min(remaining, 0.05) * 1000)
+
+
+def boundUdcs(exclude: str = None) -> Set[str]:
+    udcs: Set[str] = set()
+    for name in os.listdir(CONFIGFS_GADGETS):
+        if name == exclude:
+            continue
+        try:
+            with open(os.path.join(CONFIGFS_GADGETS, name, 'UDC')) as f:
+                udc: str = f.read().strip()
+        except OSError:
+            continue
+        if udc:
+            udcs.add(udc)
+    return udcs
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import math
+from typing import Callable, Dict, List, Mapping, Optional
+
+# Filters run per axis on the mouse motion of each IMU sample (dots over dt
+# seconds), i.e. three times per report, whether or not the mouse moved.
+
+
+class Stage:
+    # Added latency in seconds, as declared by the stage.
+    latency: float = 0.0
+
+    def process(self, dots: float, dt: float) -> float:
+        return dots
+
+
+class Ratio(Stage):
+    # ratio 0.8: plain gain, e.g. to slow the vertical axis down.
+    def __init__(self, ratio: float) -> None:
+        self.ratio = ratio
+
+    def process(self, dots: float, dt: float) -> float:
+        return dots * self.ratio
+
+
+class Deadzone(Stage):
+    # deadzone 20: drops speeds below 20 dots/s and shifts the rest down so
+    # the response stays continuous.
+    def __init__(self, speed: float) -> None:
+        if speed < 0:
+            raise ValueError('speed must not be negative')
+        self.speed = speed
+
+    def process(self, dots: float, dt: float) -> float:
+        cut: float = self.speed * dt
+        if dots > cut:
+            return dots - cut
+        if dots < -cut:
+            return dots + cut
+        return 0.0
+
+
+class Accel(Stage):
+    # accel 0.001 2 3: classic acceleration curve, the gain is
+    # 1 + (accel * speed) ^ (exponent - 1), limited to limit.
+    def __init__(self, accel: float, exponent: float = 2.0, limit: float = 4.0) -> None:
+        if accel < 0:
+            raise ValueError('accel must not be negative')
+        if exponent < 1:
+            raise ValueError('exponent must be at least 1')
+        self.accel = accel
+        self.exponent = exponent - 1
+        self.limit = limit
+
+    def process(self, dots: float, dt: float) -> float:
+        gain: float = 1 + (self.accel * abs(dots) / dt) ** self.exponent
+        return dots * min(gain, self.limit)
+
+
+class Ema(Stage):
+    # ema 0.004: exponential moving average of the speed with a 4 ms time
+    # constant.
+    def __init__(self, tau: float) -> None:
+        if tau <= 0:
+            raise ValueError('time constant must be positive')
+        self.tau = tau
+        self.latency = tau
+        self.speed: float = 0.0
+
+    def process(self, dots: float, dt: float) -> float:
+        self.speed += (dots / dt - self.speed) * (1 - math.exp(-dt / self.tau))
+        return self.speed * dt
+
+
+class OneEuro(Stage):
+    # oneeuro 1.0 0.007 1.0: One Euro filter on the speed (minimum cutoff in
+    # Hz, speed coefficient, derivative cutoff in Hz). Smooths slow motion
+    # and lets fast flicks through; the worst case lag is at the minimum
+    # cutoff.
+    def __init__(self, mincutoff: float = 1.0, beta: float = 0.0, dcutoff: float = 1.0) -> None:
+        if mincutoff <= 0 or dcutoff <= 0:
+            raise ValueError('cutoffs must be positive')
+        if beta < 0:
+            raise ValueError('beta must not be negative')
+        self.mincutoff = mincutoff
+        self.beta = beta
+        self.dcutoff = dcutoff
+        self.latency = 1 / (2 * math.pi * mincutoff)
+        self.speed: Optional[float] = None
+        self.slope: float = 0.0
+
+    @staticmethod
+    def alpha(cutoff: float, dt: float) -> float:
+        return 1 / (1 + 1 / (2 * math.pi * cutoff * dt))
+
+    def process(self, dots: float, dt: float) -> float:
+        speed: float = dots / dt
+        if self.speed is None:
+            self.speed = speed
+            return dots
+
+        slope: float = (speed - self.speed) / dt
+        self.slope += (slope - self.slope) * self.alpha(self.dcutoff, dt)
+        cutoff: float = self.mincutoff + self.beta * abs(self.slope)
+        self.speed += (speed - self.speed) * self.alpha(cutoff, dt)
+        return self.speed * dt
+
+
+STAGES: Dict[str, Callable[..., Stage]] = {
+    'ratio': Ratio,
+    'deadzone': Deadzone,
+    'accel': Accel,
+    'ema': Ema,
+    'oneeuro': OneEuro,
+}
+
+# config.ini key -> gyro axis fed by that mouse axis
+AXES: Dict[str, int] = {'vertical': 1, 'horizontal': 2}
+
+
+class FilterChain:
+    # spec is the config.ini text the chain was parsed from, kept so that
+    # recordings can rebuild it.
+    def __init__(self, stages: List[Stage], spec: str = '') -> None:
+        self.stages = stages
+        self.spec = spec
+        self.latency: float = sum(stage.latency for stage in stages)
+
+    def __call__(self, dots: float, dt: float) -> float:
+        for stage in self.stages:
+            dots = stage.process(dots, dt)
+        return dots
+
+
+def parse_chain(spec: str) -> FilterChain:
+    # "deadzone 20, accel 0.001 2 3, oneeuro 1.0 0.007"
+    stages: List[Stage] = []
+    for item in spec.split(','):
+        words: List[str] = item.split()
+        if not words:
+            continue
+        stage = STAGES.get(words[0].lower())
+        if stage is None:
+            raise ValueError(f'Unknown filter "{words[0]}"')
+        try:
+            stages.append(stage(*[float(word) for word in words[1:]]))
+        except (TypeError, ValueError) as e:
+            raise ValueError(f'Invalid parameters for filter "{item.strip()}": {e}')
+    return FilterChain(stages, spec.strip())
+
+
+def compile_filters(section: Mapping[str, str]) -> List[Optional[FilterChain]]:
+    # Returns one chain (or None) per gyro axis, as used by
+    # Controller.getSensorBuffer.
+    filters: List[Optional[FilterChain]] = [None, None, None]
+    errors: List[str] = []
+
+    for key, spec in section.items():
+        axis = AXES.get(key.strip().lower())
+        if axis is None:
+            errors.append(f'Unknown axis "{key}", expected Horizontal or Vertical')
+            continue
+        try:
+            filters[axis] = parse_chain(spec)
+        except ValueError as e:
+            errors.append(f'{key}: {e}')
+
+    if errors:
+        raise ValueError('Invalid GYROFILTER in config.ini:\n\t' + '\n\t'.join(errors))
+
+    return filters
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import asyncio
+import time
+from typing import Callable, List, Optional, Set, Tuple
+
+import evdev.ecodes as ev
+from evdev import InputDevice, InputEvent
+
+from keymap import KeyMap
+from nscon import Controller
+
+
+class EventBatcher:
+    # Accumulates one device's events until SYN_REPORT and then applies the
+    # whole frame to the controller state: relative motion is summed into a
+    # single gyro update and key transitions are replayed in order. After
+    # SYN_DROPPED the rest of the frame is discarded and the held keys are
+    # resynchronised from activeKeys (the device's active_keys()).
+    dx: int = 0
+    dy: int = 0
+    received: int = 0
+    dropping: bool = False
+    activeKeys: Optional[Callable[[], List[int]]] = None
+
+    def __init__(self, procon: Controller, keymap: KeyMap,
+                 recorder=None, device: int = 0) -> None:
+        self.procon = procon
+        self.keymap = keymap
+        self.recorder = recorder
+        self.device = device
+        self.keys: List[Tuple[int, int]] = []
+        self.pressed: Set[int] = set()
+
+    def feed(self, events, received: int = None):
+        if received is None:
+            received = time.monotonic_ns()
+        recorder = self.recorder
+        for event in events:
+            if recorder is not None:
+                recorder.event(self.device, received, event)
+            etype = event.type
+            if self.dropping:
+                if etype == ev.EV_SYN and event.code == ev.SYN_REPORT:
+                    self.dropping = False
+                    self.resync(received)
+                continue
+            # TODO: REL_WHEEL
+            if etype == ev.EV_REL:
+                if event.code == ev.REL_X:
+                    self.dx += event.value
+                elif event.code == ev.REL_Y:
+                    self.dy += event.value
+            elif etype == ev.EV_KEY:
+                if event.code in self.keymap:
+                    self.keys.append((event.code, event.value))
+            elif etype == ev.EV_SYN and event.code == ev.SYN_REPORT:
+                self.apply(self.received or received)
+                self.received = 0
+            elif etype == ev.EV_SYN and event.code == ev.SYN_DROPPED:
+                # The kernel buffer overflowed, this frame is incomplete.
+                self.dx = 0
+                self.dy = 0
+                self.keys.clear()
+                self.received = 0
+                self.dropping = True
+
+        # Part of a frame is still pending: remember when it started arriving.
+        if not self.received and (self.dx or self.dy or self.keys):
+            self.received = received
+
+    def apply(self, received: int):
+        if not (self.dx or self.dy or self.keys):
+            return
+
+        if self.dx or self.dy:
+            self.procon.addGyro(0, self.dy, -self.dx, received)
+            self.dx = 0
+            self.dy = 0
+
+        if self.keys:
+            keymap = self.keymap
+            pressed = self.pressed
+            for code, value in self.keys:
+                keymap[code](value)
+                if value:
+                    pressed.add(code)
+                else:
+                    pressed.discard(code)
+            self.keys.clear()
+
+        metrics = self.procon.metrics
+        metrics.observe('event_apply', time.monotonic_ns() - received)
+        metrics.count('input_frames')
+        self.procon.markInput(received)
+
+    def resync(self, received: int):
+        # Feeds the difference between the held keys and the device state as
+        # a regular frame, so that a recording gets it as well.
+        if self.activeKeys is None:
+            return
+        try:
+            active: Set[int] = set(self.activeKeys())
+        except OSError:
+            return
+        sec, usec = divmod(received // 1000, 1_000_000)
+        events: List[InputEvent] = [InputEvent(sec, usec, ev.EV_KEY, code, int(code in active))
+                                    for code in self.keymap if (code in active) != (code in self.pressed)]
+        if events:
+            events.append(InputEvent(sec, usec, ev.EV_SYN, ev.SYN_REPORT, 0))
+            self.feed(events, received)
+
+    def setKeymap(self, keymap: KeyMap):
+        # Keys held across the swap move from their old to their new target.
+        pressed: List[int] = list(self.pressed)
+        for code in pressed:
+            setter = self.keymap.get(code)
+            if setter is not None:
+                setter(0)
+        self.keymap = keymap
+        for code in pressed:
+            setter = keymap.get(code)
+            if setter is not None:
+                setter(1)
+            else:
+                self.pressed.discard(code)
+        self.keys = [(code, value) for code, value in self.keys if code in keymap]
+        if pressed:
+            self.procon.markInput(time.monotonic_ns())
+
+    def release(self):
+        # The device went away: let go of whatever it was holding down.
+        if self.recorder is not None:
+            self.recorder.release(self.device, time.monotonic_ns())
+        self.dx = 0
+        self.dy = 0
+        self.keys.clear()
+        self.received = 0
+        if self.pressed:
+            for code in self.pressed:
+                setter = self.keymap.get(code)
+                if setter is not None:
+                    setter(0)
+            self.pressed.clear()
+            self.procon.markInput(time.monotonic_ns())
+
+
+def attach(loop: asyncio.AbstractEventLoop, device: InputDevice, batcher: EventBatcher,
+           lost: Callable[[InputDevice], None] = None):
+    batcher.activeKeys = device.active_keys
+
+    def drain():
+        try:
+            batcher.feed(device.read())
+        except BlockingIOError:
+            pass
+        except OSError:
+            print(f'Input device lost: {device.path} {device.name}')
+            loop.remove_reader(device.fd)
+            batcher.release()
+            if lost is not None:
+                lost(device)
+
+    loop.add_reader(device.fd, drain)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import ctypes
+import os
+import struct
+from typing import Dict, List, Tuple
+
+IN_ATTRIB: int = 0x00000004
+IN_CLOSE_WRITE: int = 0x00000008
+IN_MOVED_TO: int = 0x00000080
+IN_CREATE: int = 0x00000100
+IN_DELETE: int = 0x00000200
+IN_IGNORED: int = 0x00008000
+
+# wd, mask, cookie, name length; followed by the NUL padded name
+EVENT: struct.Struct = struct.Struct('iIII')
+
+libc = ctypes.CDLL(None, use_errno=True)
+
+
+class Inotify:
+    # Minimal non-blocking inotify wrapper, meant to be registered with
+    # loop.add_reader(inotify.fd, ...) and drained with read().
+    def __init__(self) -> None:
+        self.fd: int = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno: int = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.paths: Dict[int, str] = {}
+
+    def watch(self, path: str, mask: int) -> int:
+        wd: int = libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno: int = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.paths[wd] = path
+        return wd
+
+    def read(self) -> List[Tuple[str, int, str]]:
+        # Returns (watched path, mask, name) for every queued event.
+        events: List[Tuple[str, int, str]] = []
+        while True:
+            try:
+                data: bytes = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return events
+
+            offset: int = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name: str = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                events.append((self.paths.get(wd, ''), mask, name))
+                if mask & IN_IGNORED:
+                    self.paths.pop(wd, None)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
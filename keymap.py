@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+from typing import Callable, Dict, List, Mapping
+
+import evdev.ecodes as ev
+
+from nscon import ControllerInput, INPUT_TARGETS, input_setter
+
+KeyMap = Dict[int, Callable[[int], None]]
+
+
+def compile_keymap(procon: ControllerInput, keyconfig: Mapping[str, str]) -> KeyMap:
+    keymap: KeyMap = {}
+    errors: List[str] = []
+
+    for key, target in keyconfig.items():
+        key = key.strip().upper()
+        target = target.strip().upper()
+        # Only keys and buttons: other evdev names (REL_*, ABS_*, SYN_*) share
+        # their codes with keys and would silently bind the wrong one.
+        code = ev.ecodes.get(key) if key.startswith(('KEY_', 'BTN_')) else None
+        if code is None or (code not in ev.KEY and code not in ev.BTN):
+            errors.append(f'Unknown key "{key}"')
+        elif target not in INPUT_TARGETS:
+            errors.append(f'Unknown controller input "{target}" for {key}')
+        else:
+            keymap[code] = input_setter(procon, target)
+
+    if errors:
+        raise ValueError('Invalid KEYCONFIG in config.ini:\n\t' + '\n\t'.join(errors))
+
+    return keymap
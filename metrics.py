@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+from typing import Dict, List, Tuple
+
+HISTOGRAM_BUCKETS: int = 40
+
+
+class Histogram:
+    # Latency histogram with power-of-two nanosecond buckets: observing is a
+    # bit_length() and a list increment, cheap enough for every report.
+    def __init__(self) -> None:
+        self.buckets: List[int] = [0] * HISTOGRAM_BUCKETS
+        self.count: int = 0
+        self.sum: int = 0
+
+    def observe(self, ns: int):
+        if ns < 0:
+            ns = 0
+        index: int = ns.bit_length()
+        if index >= HISTOGRAM_BUCKETS:
+            index = HISTOGRAM_BUCKETS - 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.sum += ns
+
+    def add(self, other: 'Histogram'):
+        for index, value in enumerate(other.buckets):
+            self.buckets[index] += value
+        self.count += other.count
+        self.sum += other.sum
+
+    def render(self, name: str, labels: str) -> List[str]:
+        lines: List[str] = []
+        total: int = 0
+        for index, value in enumerate(self.buckets):
+            total += value
+            if value or index == HISTOGRAM_BUCKETS - 1:
+                le: float = (1 << index) / 1e9
+                lines.append(f'{name}_bucket{{{labels},le="{le:.9g}"}} {total}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum / 1e9:.9f}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+# name -> help text
+COUNTERS: Dict[str, str] = {
+    'reports_sent': 'Input reports (0x30) written to the gadget',
+    'reports_dropped': 'Input reports dropped because the gadget was not writable or the host was gone',
+    'replies_sent': 'Handshake and UART replies written to the gadget',
+    'replies_dropped': 'Handshake and UART replies dropped because the queue was full or the host was gone',
+    'handshake_requests': 'USB handshake (0x80) requests received',
+    'subcommand_requests': 'UART subcommand (0x01) requests received',
+    'input_frames': 'Input device frames (SYN_REPORT) applied',
+    'control_commands': 'Control API commands and state block updates applied',
+    'control_rejected': 'Control API datagrams or commands rejected as malformed',
+}
+
+# name -> help text
+GAUGES: Dict[str, str] = {
+    'reply_queue_depth': 'Replies waiting for the gadget to become writable',
+    'first_report_seconds': 'Time from enabling the USB gadget to the first input report',
+}
+
+# name -> help text
+STAGES: Dict[str, str] = {
+    'event_apply': 'Input event received to controller state applied',
+    'report_encode': 'Time spent encoding an input report',
+    'report_write': 'Time spent writing an input report',
+    'event_to_report': 'Oldest unreported input event to input report written',
+}
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.counters: Dict[str, int] = {name: 0 for name in COUNTERS}
+        self.gauges: Dict[str, float] = {name: 0 for name in GAUGES}
+        self.stages: Dict[str, Histogram] = {name: Histogram() for name in STAGES}
+
+    def count(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def observe(self, stage: str, ns: int):
+        self.stages[stage].observe(ns)
+
+    def add(self, other: 'Metrics'):
+        # Counters and histograms of another process for the same controller;
+        # gauges stay our own.
+        for name, value in other.counters.items():
+            self.counters[name] += value
+        for name, histogram in other.stages.items():
+            self.stages[name].add(histogram)
+
+
+def render(sources: List[Tuple[Dict[str, str], Metrics, Dict[str, float]]]) -> str:
+    lines: List[str] = []
+    for name, help in COUNTERS.items():
+        lines.append(f'# HELP nscon_{name}_total {help}')
+        lines.append(f'# TYPE nscon_{name}_total counter')
+        for labels, metrics, ticker in sources:
+            lines.append(f'nscon_{name}_total{{{format_labels(labels)}}} {metrics.counters[name]}')
+
+    for name, help in GAUGES.items():
+        lines.append(f'# HELP nscon_{name} {help}')
+        lines.append(f'# TYPE nscon_{name} gauge')
+        for labels, metrics, ticker in sources:
+            lines.append(f'nscon_{name}{{{format_labels(labels)}}} {metrics.gauges[name]}')
+
+    for name, help in STAGES.items():
+        lines.append(f'# HELP nscon_{name}_seconds {help}')
+        lines.append(f'# TYPE nscon_{name}_seconds histogram')
+        for labels, metrics, ticker in sources:
+            lines += metrics.stages[name].render(f'nscon_{name}_seconds', format_labels(labels))
+
+    lines.append('# HELP nscon_ticker_overruns_total Report deadlines missed by the ticker')
+    lines.append('# TYPE nscon_ticker_overruns_total counter')
+    for labels, metrics, ticker in sources:
+        lines.append(f'nscon_ticker_overruns_total{{{format_labels(labels)}}} {ticker.get("overruns", 0)}')
+    lines.append('# HELP nscon_ticker_errors_total Report callbacks that raised an exception')
+    lines.append('# TYPE nscon_ticker_errors_total counter')
+    for labels, metrics, ticker in sources:
+        lines.append(f'nscon_ticker_errors_total{{{format_labels(labels)}}} {ticker.get("errors", 0)}')
+    lines.append('# HELP nscon_ticker_jitter_seconds Ticker wake-up lateness')
+    lines.append('# TYPE nscon_ticker_jitter_seconds gauge')
+    for labels, metrics, ticker in sources:
+        for stat in ['mean', 'max']:
+            value: float = ticker.get(f'jitter_{stat}_us', 0) / 1e6
+            lines.append(f'nscon_ticker_jitter_seconds{{{format_labels(labels)},stat="{stat}"}} {value:.9f}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    return ','.join(f'{key}="{value}"' for key, value in labels.items())
+
+
+class MetricsServer:
+    # Serves the Prometheus text format on a Unix socket (one scrape per
+    # connection) and/or rewrites a node_exporter textfile periodically.
+    def __init__(self, controllers: list, socketPath: str = None,
+                 textfilePath: str = None, textfileSec: float = 10.0) -> None:
+        self.controllers = controllers
+        self.socketPath = socketPath
+        self.textfilePath = textfilePath
+        self.textfileSec = textfileSec
+        self.server = None
+
+    def render(self) -> str:
+        sources: List[Tuple[Dict[str, str], Metrics, Dict[str, float]]] = []
+        for procon in self.controllers:
+            if procon.reporter != None:
+                # Reports are written, counted and timed by the report process.
+                metrics, ticker = procon.reporter.stats(procon.metrics)
+            else:
+                metrics = procon.metrics
+                ticker = procon.ticker.stats() if procon.ticker != None else {}
+            sources.append(({'gadget': procon.path}, metrics, ticker))
+        return render(sources)
+
+    async def start(self):
+        if self.socketPath:
+            if os.path.exists(self.socketPath):
+                os.unlink(self.socketPath)
+            self.server = await asyncio.start_unix_server(self.serve, self.socketPath)
+        if self.textfilePath:
+            asyncio.get_running_loop().call_soon(self.writeTextfile)
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(self.render().encode())
+        await writer.drain()
+        writer.close()
+
+    def writeTextfile(self):
+        tmp: str = self.textfilePath + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, self.textfilePath)
+        asyncio.get_running_loop().call_later(self.textfileSec, self.writeTextfile)
+
+    def close(self):
+        if self.server != None:
+            self.server.close()
+            self.server = None
+        if self.socketPath and os.path.exists(self.socketPath):
+            os.unlink(self.socketPath)
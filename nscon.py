@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 
-from concurrent.futures import ThreadPoolExecutor, Future
-from dataclasses import dataclass, field
-import signal
+import asyncio
+import errno
+from dataclasses import dataclass, field, fields
 import struct
 import os
-from typing import Dict, List
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from metrics import Metrics
+from outbox import Outbox
+from spiflash import SpiFlash
+from ticker import Ticker, TickerTask
 
 
 SPI_ROM_DATA: Dict[int, bytes] = {
@@ -31,8 +37,101 @@ SPI_ROM_DATA: Dict[int, bytes] = {
 }
 
 
+# Layout of the 64 byte report frame sent to the host.
+REPORT_SIZE: int = 64
+INPUT_OFFSET: int = 2
+SENSOR_OFFSET: int = 13
+SENSOR_SAMPLES: int = 3
+UART_OFFSET: int = 13
+
+IMU_SAMPLE: struct.Struct = struct.Struct('<6H')
+
+# Selectable input report periods, ReportPeriod in config.ini (ms) -> seconds.
+REPORT_PERIODS: Dict[int, float] = {15: 0.015, 8: 0.008, 4: 0.004}
+
+# attribute -> (frame offset, bit mask)
+BUTTON_BITS: Dict[str, Tuple[int, int]] = {
+    'Y': (3, 0x01), 'X': (3, 0x02), 'B': (3, 0x04), 'A': (3, 0x08),
+    'R': (3, 0x40), 'ZR': (3, 0x80),
+    'Minus': (4, 0x01), 'Plus': (4, 0x02), 'Home': (4, 0x10), 'Capture': (4, 0x20),
+    'L': (5, 0x40), 'ZL': (5, 0x80),
+}
+DPAD_BITS: Dict[str, Tuple[int, int]] = {
+    'Down': (5, 0x01), 'Up': (5, 0x02), 'Right': (5, 0x04), 'Left': (5, 0x08),
+}
+LSTICK_BITS: Dict[str, Tuple[int, int]] = {'Press': (4, 0x08)}
+RSTICK_BITS: Dict[str, Tuple[int, int]] = {'Press': (4, 0x04)}
+LSTICK_OFFSET: int = 6
+RSTICK_OFFSET: int = 9
+
+# Report bytes 3..5 as one 24 bit button field:
+# name -> (ControllerInput member, attribute, bit)
+REPORT_BUTTONS: Dict[str, Tuple[str, str, int]] = {}
+for member, prefix, bits in [('Button', '', BUTTON_BITS), ('Dpad', 'Dpad', DPAD_BITS),
+                             ('Stick.Left', 'LStick', LSTICK_BITS),
+                             ('Stick.Right', 'RStick', RSTICK_BITS)]:
+    for name, (offset, mask) in bits.items():
+        REPORT_BUTTONS[prefix + name] = (member, name, (offset - 3) * 8 + mask.bit_length() - 1)
+
+
+# config.ini target -> (ControllerInput member, attribute, stick value while pressed)
+INPUT_TARGETS: Dict[str, Tuple[str, str, Optional[int]]] = {
+    'BUTTON_A': ('Button', 'A', None),
+    'BUTTON_B': ('Button', 'B', None),
+    'BUTTON_X': ('Button', 'X', None),
+    'BUTTON_Y': ('Button', 'Y', None),
+    'BUTTON_R': ('Button', 'R', None),
+    'BUTTON_ZR': ('Button', 'ZR', None),
+    'BUTTON_L': ('Button', 'L', None),
+    'BUTTON_ZL': ('Button', 'ZL', None),
+    'BUTTON_HOME': ('Button', 'Home', None),
+    'BUTTON_PLUS': ('Button', 'Plus', None),
+    'BUTTON_MINUS': ('Button', 'Minus', None),
+    'BUTTON_CAPTURE': ('Button', 'Capture', None),
+    'DPAD_UP': ('Dpad', 'Up', None),
+    'DPAD_DOWN': ('Dpad', 'Down', None),
+    'DPAD_LEFT': ('Dpad', 'Left', None),
+    'DPAD_RIGHT': ('Dpad', 'Right', None),
+    'LSTICK_UP': ('Stick.Left', 'Y', 0xFFF),
+    'LSTICK_DOWN': ('Stick.Left', 'Y', 0x000),
+    'LSTICK_LEFT': ('Stick.Left', 'X', 0x000),
+    'LSTICK_RIGHT': ('Stick.Left', 'X', 0xFFF),
+    'LSTICK_PRESS': ('Stick.Left', 'Press', None),
+    'RSTICK_UP': ('Stick.Right', 'Y', 0xFFF),
+    'RSTICK_DOWN': ('Stick.Right', 'Y', 0x000),
+    'RSTICK_LEFT': ('Stick.Right', 'X', 0x000),
+    'RSTICK_RIGHT': ('Stick.Right', 'X', 0xFFF),
+    'RSTICK_PRESS': ('Stick.Right', 'Press', None),
+}
+
+
+class FrameField:
+    # Mirrors attribute writes into the report frame it is bound to, so the
+    # frame is always up to date and never has to be rebuilt per report.
+    _frame: Optional[bytearray] = None
+    _bits: Dict[str, Tuple[int, int]] = {}
+
+    def bind(self, frame: bytearray, bits: Dict[str, Tuple[int, int]]):
+        object.__setattr__(self, '_frame', frame)
+        object.__setattr__(self, '_bits', bits)
+        for f in fields(self):
+            setattr(self, f.name, getattr(self, f.name))
+
+    def __setattr__(self, name: str, value) -> None:
+        object.__setattr__(self, name, value)
+        frame = self._frame
+        if frame is None:
+            return
+        bit = self._bits.get(name)
+        if bit is not None:
+            if value:
+                frame[bit[0]] |= bit[1]
+            else:
+                frame[bit[0]] &= ~bit[1]
+
+
 @dataclass
-class Dpad:
+class Dpad(FrameField):
     Up: int = field(default=0, init=False)
     Down: int = field(default=0, init=False)
     Left: int = field(default=0, init=False)
@@ -40,7 +139,7 @@ class Dpad:
 
 
 @dataclass
-class Button:
+class Button(FrameField):
     A: int = field(default=0, init=False)
     B: int = field(default=0, init=False)
     X: int = field(default=0, init=False)
@@ -56,16 +155,36 @@ class Button:
 
 
 @dataclass
-class Stick_struct:
+class Stick_struct(FrameField):
     X: int = field(default=0x800, init=False)
     Y: int = field(default=0x800, init=False)
     Press: int = field(default=0, init=False)
+    _offset = 0
+
+    def bindStick(self, frame: bytearray, bits: Dict[str, Tuple[int, int]], offset: int):
+        object.__setattr__(self, '_offset', offset)
+        self.bind(frame, bits)
+
+    def __setattr__(self, name: str, value) -> None:
+        frame = self._frame
+        if frame is None or name not in ('X', 'Y'):
+            FrameField.__setattr__(self, name, value)
+            return
+        object.__setattr__(self, name, value)
+        # Two 12 bit values packed little endian into 3 bytes.
+        offset = self._offset
+        if name == 'X':
+            frame[offset] = value & 0xFF
+            frame[offset + 1] = (frame[offset + 1] & 0xF0) | ((value >> 8) & 0x0F)
+        else:
+            frame[offset + 1] = (frame[offset + 1] & 0x0F) | ((value << 4) & 0xF0)
+            frame[offset + 2] = (value >> 4) & 0xFF
 
 
 @dataclass
 class Stick:
-    Left: Stick_struct = field(default=Stick_struct(), init=False)
-    Right: Stick_struct = field(default=Stick_struct(), init=False)
+    Left: Stick_struct = field(default_factory=Stick_struct, init=False)
+    Right: Stick_struct = field(default_factory=Stick_struct, init=False)
 
 
 @dataclass
@@ -78,33 +197,122 @@ class Sensor_struct:
 
 @dataclass
 class Sensor:
-    Accel: Sensor_struct = field(default=Sensor_struct(), init=False)
-    Gyro: Sensor_struct = field(default=Sensor_struct(), init=False)
+    Accel: Sensor_struct = field(default_factory=Sensor_struct, init=False)
+    Gyro: Sensor_struct = field(default_factory=Sensor_struct, init=False)
 
 
 @dataclass
 class ControllerInput:
-    Dpad: Dpad = field(default=Dpad(), init=False)
-    Button: Button = field(default=Button(), init=False)
-    Stick: Stick = field(default=Stick(), init=False)
-    Sensor: Sensor = field(default=Sensor(), init=False)
+    Dpad: Dpad = field(default_factory=Dpad, init=False)
+    Button: Button = field(default_factory=Button, init=False)
+    Stick: Stick = field(default_factory=Stick, init=False)
+    Sensor: Sensor = field(default_factory=Sensor, init=False)
+
+    def bind(self, frame: bytearray):
+        self.Dpad.bind(frame, DPAD_BITS)
+        self.Button.bind(frame, BUTTON_BITS)
+        self.Stick.Left.bindStick(frame, LSTICK_BITS, LSTICK_OFFSET)
+        self.Stick.Right.bindStick(frame, RSTICK_BITS, RSTICK_OFFSET)
+
+
+def uart_reply(ack: bool, subCmd: int, data: bytes) -> bytes:
+    ackByte = 0x00
+    if ack:
+        ackByte = 0x80
+        if len(data):
+            ackByte |= subCmd
+
+    return bytes([ackByte, subCmd]) + data
+
+
+# Pre-encoded replies: 0x80 handshake command -> payload, UART subcommand ->
+# ack byte, subcommand and data.
+HANDSHAKE_REPLIES: Dict[int, bytes] = {
+    0x01: bytes([0x00, 0x03, 0x00, 0x00, 0x5e, 0x00, 0x53, 0x5e]),
+    0x02: bytes(0),
+    0x03: bytes(0),
+}
+UART_REPLIES: Dict[int, bytes] = {
+    0x01: uart_reply(True, 0x01, bytes([0x03, 0x01])),
+    0x02: uart_reply(True, 0x02, bytes(
+        [0x03, 0x48, 0x03, 0x02, 0x5e, 0x53, 0x00, 0x5e, 0x00, 0x00, 0x03, 0x01])),
+    0x21: uart_reply(True, 0x21, bytes(
+        [0x01, 0x00, 0xff, 0x00, 0x03, 0x00, 0x05, 0x01])),
+}
+for subCmd in [0x03, 0x04, 0x08, 0x30, 0x38, 0x40, 0x41, 0x48]:
+    UART_REPLIES[subCmd] = uart_reply(True, subCmd, bytes(0))
+
+SPI_ADDRESS: struct.Struct = struct.Struct('<I')
+SPI_DATA_OFFSET: int = UART_OFFSET + 7
+SPI_WRITE_DONE: bytes = bytes([0x80, 0x11, 0x00])
+SPI_WRITE_FAILED: bytes = bytes([0x80, 0x11, 0x01])
+SPI_ERASE_DONE: bytes = bytes([0x80, 0x12, 0x00])
+SPI_ERASE_FAILED: bytes = bytes([0x80, 0x12, 0x01])
 
 
 class Controller:
     path: str
-    fp: str = None
-    count: int = 0
-    stopCounter: bool = True
-    stopInput: bool = True
-    stopCommunicate: bool = True
-    Input: ControllerInput = ControllerInput()
-    LogLevel: int = 0
-    executor: ThreadPoolExecutor = ThreadPoolExecutor()
-    future: Future = None
-    ReportSec: int = 0.015
-
-    def __init__(self, path) -> None:
+    fp: int
+    count: int
+    stopCounter: bool
+    stopInput: bool
+    stopCommunicate: bool
+    Input: ControllerInput
+    LogLevel: int
+    loop: asyncio.AbstractEventLoop
+    engine: Ticker
+    ticker: TickerTask
+    flash: SpiFlash
+    outbox: Outbox
+    ReportSec: float
+    CounterSec: float
+
+    def __init__(self, path, flash: SpiFlash = None, engine: Ticker = None) -> None:
+        # All state is per instance so that one process can drive several
+        # gadgets; they share the event loop and, if given, one Ticker.
         self.path = path
+        self.fp = None
+        self.count = 0
+        self.stopCounter = True
+        self.stopInput = True
+        self.stopCommunicate = True
+        self.LogLevel = 0
+        self.loop = None
+        self.ownEngine = engine == None
+        self.engine = engine if engine != None else Ticker()
+        self.ticker = None
+        self.ReportSec = 0.015
+        self.CounterSec = 0.005
+        self.counterCarry: float = 0.0
+        self.metrics = Metrics()
+        self.pendingInput: int = 0
+        self.recorder = None
+        self.reporter = None
+        self.enabledAt: int = 0
+        self.flash = flash if flash != None else SpiFlash(seed=SPI_ROM_DATA)
+        self.Input = ControllerInput()
+
+        # Persistent frames: input state patches self.report in place and
+        # replies are assembled in self.reply, so nothing is rebuilt per report.
+        self.report = bytearray(REPORT_SIZE)
+        self.report[0] = 0x30
+        self.report[INPUT_OFFSET] = 0x81
+        self.reply = bytearray(REPORT_SIZE)
+        self.inputView = memoryview(self.report)[INPUT_OFFSET:SENSOR_OFFSET]
+        self.sensorView = memoryview(self.report)[SENSOR_OFFSET:SENSOR_OFFSET + IMU_SAMPLE.size * SENSOR_SAMPLES]
+        self.Input.bind(self.report)
+        self.outbox = Outbox(self.send, self.metrics, self.report)
+
+        # Gyro motion in dots, bucketed into the IMU samples of the next
+        # report by arrival time. Two sets are swapped at report time.
+        self.gyroSamples: List[List[float]] = [[0.0, 0.0, 0.0] for _ in range(SENSOR_SAMPLES)]
+        self.spareSamples: List[List[float]] = [[0.0, 0.0, 0.0] for _ in range(SENSOR_SAMPLES)]
+        self.gyroCarry: List[float] = [0.0, 0.0, 0.0]
+        self.gyroDPS: List[int] = [0, 0, 0]
+        # Optional per axis filter chains, see gyrofilter.compile_filters().
+        self.gyroFilters: List[Optional[Callable[[float, float], float]]] = [None, None, None]
+        self.pendingGyro: Optional[Tuple[float, list]] = None
+        self.lastReport: int = time.monotonic_ns()
 
     def Close(self):
         if self.fp == None:
@@ -112,81 +320,176 @@ class Controller:
 
         self.stopCounter = True
         self.stopInput = True
-        signal.setitimer(signal.ITIMER_REAL, 0, 0)
+        if self.reporter != None:
+            self.reporter.stop()
+        if self.ticker != None:
+            self.engine.remove(self.ticker)
+            self.ticker = None
+            if self.ownEngine:
+                self.engine.stop()
         self.stopCommunicate = True
+        if self.loop != None:
+            self.loop.remove_reader(self.fp)
+            self.outbox.detach()
+            self.loop = None
 
         os.close(self.fp)
         self.fp = None
 
     def Disconnect(self):
-        buf: bytearray = bytearray(self.getInputBuffer() + bytes([0x80, 0x30]))
-        self.write(0x21, self.count, buf)
-        buf[10] = 0x0a
-        self.write(0x21, self.count, buf)
-        buf[10] = 0x09
-        self.write(0x21, self.count, buf)
+        self.uart(True, 0x30, bytes(0))
+        self.reply[12] = 0x0a
+        self.sendReply(self.reply)
+        self.reply[12] = 0x09
+        self.sendReply(self.reply)
 
     def startTicker(self):
-        tick: int = 0
+        if self.reporter != None:
+            # Reports come from the isolated report process instead.
+            self.reporter.start(self.path, self.ReportSec, self.enabledAt)
+            self.enabledAt = 0
+            self.publishState()
+            return
+
+        def tickScheduler(elapsed: int):
+            self.Counter(self.counterSteps(elapsed))
+            self.InputReport()
 
-        def tickScheduler(arg1, arg2):
-            nonlocal tick
-            tick += 1
-            self.Counter()
-            if tick % 3 == 0:
-                self.InputReport()
-                tick -= 3
+        self.ticker = self.engine.add(self.ReportSec, tickScheduler)
+        self.engine.start()
 
-        signal.signal(signal.SIGALRM, tickScheduler)
-        signal.setitimer(signal.ITIMER_REAL, 0.005, 0.005)
+    def counterSteps(self, elapsed: int) -> int:
+        # The timer byte counts CounterSec units of real time whatever the
+        # report period; the fraction is kept for the next report.
+        self.counterCarry += elapsed * self.ReportSec / self.CounterSec
+        steps: int = int(self.counterCarry)
+        self.counterCarry -= steps
+        return steps
 
-    def Counter(self):
+    def Counter(self, steps: int = 1):
         if not self.stopCounter:
-            self.count = (self.count + 1) % 256
+            self.count = (self.count + steps) % 256
 
     def InputReport(self):
         if not self.stopInput:
-            self.write(0x30, self.count, self.getInputBuffer() + self.getSensorBuffer())
-
-    def getInputBuffer(self) -> bytes:
-        left = (bitInput(self.Input.Button.Y, 0) | bitInput(self.Input.Button.X, 1) |
-                bitInput(self.Input.Button.B, 2) | bitInput(self.Input.Button.A, 3) |
-                bitInput(self.Input.Button.R, 6) | bitInput(self.Input.Button.ZR, 7))
-
-        center = (bitInput(self.Input.Button.Minus, 0) | bitInput(self.Input.Button.Plus, 1) |
-                  bitInput(self.Input.Stick.Right.Press, 2) | bitInput(self.Input.Stick.Left.Press, 3) |
-                  bitInput(self.Input.Button.Home, 4) | bitInput(self.Input.Button.Capture, 5))
-
-        right = (bitInput(self.Input.Dpad.Down, 0) | bitInput(self.Input.Dpad.Up, 1) |
-                 bitInput(self.Input.Dpad.Right, 2) | bitInput(self.Input.Dpad.Left, 3) |
-                 bitInput(self.Input.Button.L, 6) | bitInput(self.Input.Button.ZL, 7))
-
-        lx = self.Input.Stick.Left.X
-        ly = self.Input.Stick.Left.Y << 12
-        rx = self.Input.Stick.Right.X
-        ry = self.Input.Stick.Right.Y << 12
-
-        leftStick = int.to_bytes((ly | lx), 3, 'little')
-        rightStick = int.to_bytes((ry | rx), 3, 'little')
-
-        return struct.pack('B BBB 3s 3s B', 0x81, left, center, right,
-                           leftStick, rightStick, 0x00)
+            start: int = time.monotonic_ns()
+            self.report[1] = self.count
+            self.getSensorBuffer(start)
+            if self.recorder != None:
+                self.recorder.report(start, self.report)
+            encoded: int = time.monotonic_ns()
+            sent: bool = self.outbox.sendReport()
+            written: int = time.monotonic_ns()
+
+            metrics = self.metrics
+            metrics.observe('report_encode', encoded - start)
+            metrics.observe('report_write', written - encoded)
+            if sent:
+                metrics.count('reports_sent')
+                if self.enabledAt:
+                    metrics.gauges['first_report_seconds'] = (written - self.enabledAt) / 1e9
+                    self.enabledAt = 0
+                if self.pendingInput:
+                    metrics.observe('event_to_report', written - self.pendingInput)
+                    self.pendingInput = 0
+
+    def markInput(self, received: int):
+        # With a report process the oldest pending input is published and
+        # cleared once that process has reported it.
+        if not self.pendingInput or (self.reporter != None
+                                     and self.reporter.reported() == self.pendingInput):
+            self.pendingInput = received
+        self.publishState()
+
+    def publishState(self):
+        if self.reporter != None:
+            self.reporter.publish(not self.stopInput, self.Input.Sensor.Gyro.Sensitivity,
+                                  self.inputView, self.pendingInput)
+
+    def getInputBuffer(self) -> memoryview:
+        return self.inputView
+
+    def addGyro(self, x: float, y: float, z: float, timestamp: int = None):
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+        if self.reporter != None:
+            self.reporter.addGyro(x, y, z, timestamp)
+            return
+        sample: int = (timestamp - self.lastReport) * SENSOR_SAMPLES // int(self.ReportSec * 1e9)
+        if sample >= SENSOR_SAMPLES:
+            sample = SENSOR_SAMPLES - 1
+        elif sample < 0:
+            sample = 0
+
+        gyro = self.gyroSamples[sample]
+        gyro[0] += x
+        gyro[1] += y
+        gyro[2] += z
+
+    def setGyro(self, sensitivity: float, filters: list):
+        # Takes effect at the start of the next report, so no report mixes
+        # old and new settings.
+        if self.reporter != None:
+            self.Input.Sensor.Gyro.Sensitivity = sensitivity
+            self.gyroFilters = filters
+            self.publishState()
+            if self.recorder != None:
+                self.recorder.gyro(time.monotonic_ns(), sensitivity, filters)
+            return
+        self.pendingGyro = (sensitivity, filters)
+
+    def getSensorBuffer(self, now: int = None) -> memoryview:
+        if now is None:
+            now = time.monotonic_ns()
+        pending = self.pendingGyro
+        if pending is not None:
+            self.pendingGyro = None
+            self.Input.Sensor.Gyro.Sensitivity, self.gyroFilters = pending
+            if self.recorder != None:
+                self.recorder.gyro(now, *pending)
 
-    def getSensorBuffer(self) -> bytes:
         accelx = self.Input.Sensor.Accel.X & 0xFFFF
         accely = self.Input.Sensor.Accel.Y & 0xFFFF
         accelz = self.Input.Sensor.Accel.Z & 0xFFFF
 
-        dot_per_degree = self.Input.Sensor.Gyro.Sensitivity
-        gyrox = Dot2DPS(self.Input.Sensor.Gyro.X, dot_per_degree, self.ReportSec) & 0xFFFF
-        gyroy = Dot2DPS(self.Input.Sensor.Gyro.Y, dot_per_degree, self.ReportSec) & 0xFFFF
-        gyroz = Dot2DPS(self.Input.Sensor.Gyro.Z, dot_per_degree, self.ReportSec) & 0xFFFF
-
-        sixaxis: bytes = b''.join([s.to_bytes(2, 'little')
-                           for s in [accelx, accely, accelz, gyrox, gyroy, gyroz]])
+        elapsed: float = (now - self.lastReport) / 1e9
+        self.lastReport = now
+        samples = self.gyroSamples
+        self.gyroSamples = self.spareSamples
+        self.spareSamples = samples
+
+        # Direct writes to Input.Sensor.Gyro count towards the newest sample.
+        gyro = self.Input.Sensor.Gyro
+        samples[-1][0] += gyro.X
+        samples[-1][1] += gyro.Y
+        samples[-1][2] += gyro.Z
+
+        # The first samples span their nominal sub-interval, the last one
+        # whatever remains of the measured report interval.
+        subSec: float = self.ReportSec / SENSOR_SAMPLES
+        lastSec: float = max(elapsed - subSec * (SENSOR_SAMPLES - 1), subSec / 2)
+        dot_per_degree = gyro.Sensitivity
+        carry = self.gyroCarry
+        filters = self.gyroFilters
+        for i in range(SENSOR_SAMPLES):
+            psec: float = subSec if i < SENSOR_SAMPLES - 1 else lastSec
+            sample = samples[i]
+            dps = self.gyroDPS
+            for axis in range(3):
+                dot: float = sample[axis]
+                if filters[axis] is not None:
+                    dot = filters[axis](dot, psec)
+                # Motion beyond what the sample can express carries over.
+                dot += carry[axis]
+                dps[axis] = Dot2DPS(dot, dot_per_degree, psec)
+                carry[axis] = dot - DPS2Dot(dps[axis], dot_per_degree, psec)
+                sample[axis] = 0.0
+            IMU_SAMPLE.pack_into(self.report, SENSOR_OFFSET + i * IMU_SAMPLE.size,
+                                 accelx, accely, accelz,
+                                 dps[0] & 0xFFFF, dps[1] & 0xFFFF, dps[2] & 0xFFFF)
         self.resetSensors()
 
-        return sixaxis * 3
+        return self.sensorView
 
     def resetSensors(self):
         self.Input.Sensor.Accel.X = 0x0000
@@ -197,99 +500,162 @@ class Controller:
         self.Input.Sensor.Gyro.Z  = 0x0000
 
     def uart(self, ack: bool, subCmd: int, data: bytes):
-        ackByte = 0x00
-        if ack:
-            ackByte = 0x80
-            if len(data):
-                ackByte |= subCmd
-
-        self.write(0x21, self.count,
-                   self.getInputBuffer() + bytes([ackByte, subCmd]) + data)
+        self.sendUart(uart_reply(ack, subCmd, data))
+
+    def beginUart(self) -> bytearray:
+        reply = self.reply
+        reply[0] = 0x21
+        reply[1] = self.count if self.reporter == None else self.reporter.getCount()
+        reply[INPUT_OFFSET:UART_OFFSET] = self.inputView
+        return reply
+
+    def sendUart(self, tail: bytes):
+        end: int = UART_OFFSET + len(tail)
+        reply = self.beginUart()
+        reply[UART_OFFSET:end] = tail
+        reply[end:] = bytes(REPORT_SIZE - end)
+        self.sendReply(reply)
 
     def write(self, ack: int, cmd: int, buf: bytes):
-        data = bytes([ack, cmd]) + buf + bytes(62 - len(buf))
+        end: int = 2 + len(buf)
+        reply = self.reply
+        reply[0] = ack
+        reply[1] = cmd
+        reply[2:end] = buf
+        reply[end:] = bytes(REPORT_SIZE - end)
+        self.sendReply(reply)
+
+    def sendReply(self, data: bytearray):
+        self.outbox.sendReply(data)
+
+    def send(self, data: bytearray) -> Optional[bool]:
+        # True once written, False if the gadget would block and None if the
+        # data was dropped because the host is gone.
         if self.LogLevel > 4:
             print('<<<', data.hex())
         try:
             os.write(self.fp, data)
         except BlockingIOError:
-            pass
+            return False
+        except OSError as e:
+            if e.errno != errno.ESHUTDOWN:
+                os._exit(1)
+            # The host went away (e.g. the console went to sleep). Drop the
+            # data and wait for it to enumerate and handshake again.
+            if not self.stopInput:
+                print('---- ProCon Host Disconnected. ----')
+                self.stopInput = True
+                self.publishState()
+            return None
         except:
             os._exit(1)
+        return True
 
-    def startConnect(self):
+    def startConnect(self, loop: asyncio.AbstractEventLoop = None, fp: int = None):
         print('---- ProCon Connection Started. ----')
         if self.fp != None:
             return
 
-        try:
-            self.fp = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
-        except:
-            return
+        if fp != None:
+            os.set_blocking(fp, False)
+            self.fp = fp
+        else:
+            try:
+                self.fp = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+            except:
+                return
 
         self.stopCounter = False
         self.stopCommunicate = False
 
         self.startTicker()
 
-        def Connect(self):
-            buf: bytes = bytes(128)
-
-            while (not self.stopCommunicate):
-                try:
-                    buf = os.read(self.fp, 128)
-                    if self.LogLevel > 4:
-                                print('>>>', buf.hex())
-                    if buf[0] == 0x80:
-                        if buf[1] == 0x01:
-                            self.write(0x81, buf[1], bytes(
-                                [0x00, 0x03, 0x00, 0x00, 0x5e, 0x00, 0x53, 0x5e]))
-                        elif buf[1] in [0x02, 0x03]:
-                            self.write(0x81, buf[1], bytes(0))
-                        elif buf[1] == 0x04:
-                            print('---- ProCon Input Report Started. ----')
-                            self.stopInput = False
-                        else:
-                            print('>>>', buf.hex())
-                    elif buf[0] == 0x01:
-                        if buf[10] == 0x01:
-                            self.uart(True, buf[10], bytes([0x03, 0x01]))
-                        elif buf[10] == 0x02:
-                            self.uart(True, buf[10], bytes(
-                                [0x03, 0x48, 0x03, 0x02, 0x5e, 0x53, 0x00, 0x5e, 0x00, 0x00, 0x03, 0x01]))
-                        elif buf[10] in [0x03, 0x08, 0x30, 0x38, 0x40, 0x41, 0x48]:
-                            self.uart(True, buf[10], bytes(0))
-                        elif buf[10] == 0x04:
-                            self.uart(True, buf[10], bytes(0))
-                        elif buf[10] == 0x10:
-                            if buf[12] in SPI_ROM_DATA:
-                                data = SPI_ROM_DATA[buf[12]]
-                                self.uart(
-                                    True, buf[10], buf[11:16] + data[buf[11]:(buf[11]+buf[15])])
-                                if self.LogLevel > 1:
-                                    print(
-                                        f"Read SPI address: {buf[12]:02x}{buf[11]:02x}[{buf[15]}] {data[buf[11]:buf[11]+buf[15]]}")
-                            else:
-                                self.uart(False, buf[10], bytes(0))
-                                if self.LogLevel > 1:
-                                    print(
-                                        f"Unknown SPI address: {buf[12]:02x}[{buf[15]}]")
-                        elif buf[10] == 0x21:
-                            self.uart(True, buf[10], bytes(
-                                [0x01, 0x00, 0xff, 0x00, 0x03, 0x00, 0x05, 0x01]))
-                        else:
-                            if self.LogLevel > 1:
-                                print(f"UART unknown request {buf[10]} {buf}")
-                except BlockingIOError:
-                    pass
-                except:
-                    os._exit(1)
-
-        self.future = self.executor.submit(Connect, self)
-
-
-def bitInput(input, offset: int) -> int:
-    return 1 << offset if input else 0
+        self.loop = loop if loop != None else asyncio.get_event_loop()
+        self.outbox.attach(self.fp, self.loop)
+        self.loop.add_reader(self.fp, self.Receive)
+
+    def Receive(self):
+        while not self.stopCommunicate:
+            try:
+                buf = os.read(self.fp, 128)
+                if self.LogLevel > 4:
+                    print('>>>', buf.hex())
+                self.Request(buf)
+            except BlockingIOError:
+                return
+            except:
+                os._exit(1)
+
+    def Request(self, buf: bytes):
+        if buf[0] == 0x80:
+            self.metrics.count('handshake_requests')
+            reply = HANDSHAKE_REPLIES.get(buf[1])
+            if reply is not None:
+                self.write(0x81, buf[1], reply)
+            elif buf[1] == 0x04:
+                print('---- ProCon Input Report Started. ----')
+                self.stopInput = False
+                self.publishState()
+            else:
+                print('>>>', buf.hex())
+        elif buf[0] == 0x01:
+            self.metrics.count('subcommand_requests')
+            reply = UART_REPLIES.get(buf[10])
+            if reply is not None:
+                self.sendUart(reply)
+            elif buf[10] == 0x10:
+                self.spiRead(buf)
+            elif buf[10] == 0x11:
+                self.spiWrite(buf)
+            elif buf[10] == 0x12:
+                self.spiErase(buf)
+            else:
+                if self.LogLevel > 1:
+                    print(f"UART unknown request {buf[10]} {buf}")
+
+    def spiRead(self, buf: bytes):
+        address: int = SPI_ADDRESS.unpack_from(buf, 11)[0]
+        length: int = buf[15]
+        if length > REPORT_SIZE - SPI_DATA_OFFSET or not self.flash.contains(address, length):
+            self.uart(False, 0x10, bytes(0))
+            if self.LogLevel > 1:
+                print(f"Unknown SPI address: {address:05x}[{length}]")
+            return
+
+        end: int = SPI_DATA_OFFSET + length
+        reply = self.beginUart()
+        reply[UART_OFFSET] = 0x90
+        reply[UART_OFFSET + 1] = 0x10
+        reply[UART_OFFSET + 2:SPI_DATA_OFFSET] = buf[11:16]
+        reply[SPI_DATA_OFFSET:end] = self.flash.read(address, length)
+        reply[end:] = bytes(REPORT_SIZE - end)
+        self.sendReply(reply)
+        if self.LogLevel > 1:
+            print(f"Read SPI address: {address:05x}[{length}] {reply[SPI_DATA_OFFSET:end].hex()}")
+
+    def spiWrite(self, buf: bytes):
+        address: int = SPI_ADDRESS.unpack_from(buf, 11)[0]
+        length: int = buf[15]
+        if length > len(buf) - 16 or not self.flash.contains(address, length):
+            self.sendUart(SPI_WRITE_FAILED)
+            return
+
+        self.flash.write(address, buf[16:16 + length])
+        self.sendUart(SPI_WRITE_DONE)
+        if self.LogLevel > 1:
+            print(f"Write SPI address: {address:05x}[{length}] {buf[16:16 + length].hex()}")
+
+    def spiErase(self, buf: bytes):
+        address: int = SPI_ADDRESS.unpack_from(buf, 11)[0]
+        if not self.flash.contains(address, 1):
+            self.sendUart(SPI_ERASE_FAILED)
+            return
+
+        self.flash.erase(address)
+        self.sendUart(SPI_ERASE_DONE)
+        if self.LogLevel > 1:
+            print(f"Erase SPI sector: {address:05x}")
+
 
 def Dot2DPS(dot: int, dot_per_degree: float, psec: float) -> int:
     degree: float = dot / dot_per_degree
@@ -300,32 +666,30 @@ def Dot2DPS(dot: int, dot_per_degree: float, psec: float) -> int:
     
     return dps_digit
 
+def DPS2Dot(dps_digit: int, dot_per_degree: float, psec: float) -> float:
+    return dps_digit * 0.07 * psec * dot_per_degree
+
+def input_setter(procon: ControllerInput, code: str) -> Callable[[int], None]:
+    path, attr, pressed = INPUT_TARGETS[code]
+    target = procon
+    for name in path.split('.'):
+        target = getattr(target, name)
+
+    if pressed is None:
+        def set_button(event_value: int):
+            setattr(target, attr, 1 if event_value > 0 else 0)
+        return set_button
+
+    def set_stick(event_value: int):
+        setattr(target, attr, pressed if event_value else 0x800)
+    return set_stick
+
 def set_controller_input(procon: ControllerInput, code: str, event_value: any):
-    onoff_value: int = int(event_value > 0)
-
-    if   code == 'BUTTON_A': procon.Button.A = onoff_value
-    elif code == 'BUTTON_B': procon.Button.B = onoff_value
-    elif code == 'BUTTON_X': procon.Button.X = onoff_value
-    elif code == 'BUTTON_Y': procon.Button.Y = onoff_value
-    elif code == 'BUTTON_R': procon.Button.R = onoff_value
-    elif code == 'BUTTON_ZR': procon.Button.ZR = onoff_value
-    elif code == 'BUTTON_L': procon.Button.L = onoff_value
-    elif code == 'BUTTON_ZL': procon.Button.ZL = onoff_value
-    elif code == 'BUTTON_HOME': procon.Button.Home = onoff_value
-    elif code == 'BUTTON_PLUS': procon.Button.Plus = onoff_value
-    elif code == 'BUTTON_MINUS': procon.Button.Minus = onoff_value
-    elif code == 'BUTTON_CAPTUER': procon.Button.Capture = onoff_value
-    elif code == 'DPAD_UP': procon.Dpad.Up = onoff_value
-    elif code == 'DPAD_DOWN': procon.Dpad.Down = onoff_value
-    elif code == 'DPAD_LEFT': procon.Dpad.Left = onoff_value
-    elif code == 'DPAD_RIGHT': procon.Dpad.Right = onoff_value
-    elif code == 'LSTICK_UP': procon.Stick.Left.Y = event_value
-    elif code == 'LSTICK_DOWN': procon.Stick.Left.Y = event_value
-    elif code == 'LSTICK_LEFT': procon.Stick.Left.X = event_value
-    elif code == 'LSTICK_RIGHT': procon.Stick.Left.X = event_value
-    elif code == 'LSTICK_PRESS': procon.Stick.Left.Press = onoff_value
-    elif code == 'RSTICK_UP': procon.Stick.Right.Y = event_value
-    elif code == 'RSTICK_DOWN': procon.Stick.Right.Y = event_value
-    elif code == 'RSTICK_LEFT': procon.Stick.Right.X = event_value
-    elif code == 'RSTICK_RIGHT': procon.Stick.Right.X = event_value
-    elif code == 'RSTICK_PRESS': procon.Stick.Right.Press = onoff_value
\ No newline at end of file
+    if code not in INPUT_TARGETS:
+        return
+
+    path, attr, pressed = INPUT_TARGETS[code]
+    target = procon
+    for name in path.split('.'):
+        target = getattr(target, name)
+    setattr(target, attr, int(event_value > 0) if pressed is None else event_value)
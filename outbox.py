@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import asyncio
+from collections import deque
+from typing import Callable, Deque, Optional
+
+from metrics import Metrics
+
+
+class Outbox:
+    # Outgoing traffic with per-class policies for when the gadget returns
+    # EAGAIN. Handshake and UART replies are queued and delivered in order
+    # once the fd is writable again. An input report that cannot be written
+    # is dropped: the next tick writes a fresh frame, a stale one is
+    # worthless, and the report buffer belongs to the ticker thread.
+    # write() returns None for data dropped because the host is gone, which
+    # is counted as dropped and not retried.
+    fp: int = None
+    loop: asyncio.AbstractEventLoop = None
+    watching: bool = False
+
+    def __init__(self, write: Callable[[bytearray], Optional[bool]], metrics: Metrics,
+                 report: bytearray, maxReplies: int = 32) -> None:
+        self.write = write
+        self.metrics = metrics
+        self.report = report
+        self.maxReplies = maxReplies
+        self.replies: Deque[bytes] = deque()
+
+    def attach(self, fp: int, loop: asyncio.AbstractEventLoop):
+        self.fp = fp
+        self.loop = loop
+
+    def detach(self):
+        if self.watching:
+            self.loop.remove_writer(self.fp)
+            self.watching = False
+        self.replies.clear()
+        self.metrics.gauges['reply_queue_depth'] = 0
+        self.fp = None
+        self.loop = None
+
+    def sendReply(self, data: bytearray):
+        if not self.replies:
+            sent: Optional[bool] = self.write(data)
+            if sent is not False:
+                self.metrics.count('replies_sent' if sent else 'replies_dropped')
+                return
+
+        if len(self.replies) >= self.maxReplies or self.loop is None:
+            self.metrics.count('replies_dropped')
+            return
+        self.replies.append(bytes(data))
+        self.metrics.gauges['reply_queue_depth'] = len(self.replies)
+        self.watch()
+
+    def sendReport(self) -> bool:
+        # Called from the ticker thread.
+        if self.write(self.report):
+            return True
+        self.metrics.count('reports_dropped')
+        return False
+
+    def watch(self):
+        if not self.watching and self.fp is not None:
+            self.watching = True
+            self.loop.add_writer(self.fp, self.onWritable)
+
+    def onWritable(self):
+        while self.replies:
+            sent: Optional[bool] = self.write(self.replies[0])
+            if sent is False:
+                return
+            self.replies.popleft()
+            self.metrics.count('replies_sent' if sent else 'replies_dropped')
+        self.metrics.gauges['reply_queue_depth'] = 0
+
+        self.loop.remove_writer(self.fp)
+        self.watching = False
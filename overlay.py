@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import errno
+import os
+import signal
+import struct
+import sys
+import time
+from configparser import ConfigParser
+from typing import Dict, List
+
+import nscon
+from devices import DeviceManager, guess_devices
+from gadget import Gadget
+from gyrofilter import compile_filters
+from keymap import compile_keymap
+from metrics import MetricsServer
+
+# Signed gyro x, y, z within one IMU sample of the report.
+GYRO_AXES: struct.Struct = struct.Struct('<3h')
+GYRO_OFFSET: int = 6
+STICK_SIZE: int = 3
+BUTTON_BYTES: List[int] = [3, 4, 5]
+# Weight of each new interval between real 0x30 reports in the average that
+# becomes the report period of the overlay controller.
+INTERVAL_WEIGHT: float = 1 / 16
+
+
+class Overlay:
+    # Merges keyboard and mouse input into the 0x30 reports of a real
+    # controller. The input devices drive an unconnected Controller as usual,
+    # so its report frame always holds their state; patch() then only ORs in
+    # the button bytes, copies a stick that is off centre and adds the
+    # mouse gyro rate to the three IMU samples, in place.
+    def __init__(self, procon: nscon.Controller) -> None:
+        self.procon = procon
+        self.left = procon.Input.Stick.Left
+        self.right = procon.Input.Stick.Right
+
+    def patch(self, buf: bytearray, now: int):
+        own: bytearray = self.procon.report
+        for offset in BUTTON_BYTES:
+            buf[offset] |= own[offset]
+
+        left = self.left
+        if left.X != 0x800 or left.Y != 0x800:
+            buf[nscon.LSTICK_OFFSET:nscon.LSTICK_OFFSET + STICK_SIZE] = \
+                own[nscon.LSTICK_OFFSET:nscon.LSTICK_OFFSET + STICK_SIZE]
+        right = self.right
+        if right.X != 0x800 or right.Y != 0x800:
+            buf[nscon.RSTICK_OFFSET:nscon.RSTICK_OFFSET + STICK_SIZE] = \
+                own[nscon.RSTICK_OFFSET:nscon.RSTICK_OFFSET + STICK_SIZE]
+
+        # Mouse motion since the previous real report, as rates per sample.
+        self.procon.getSensorBuffer(now)
+        for i in range(nscon.SENSOR_SAMPLES):
+            offset: int = nscon.SENSOR_OFFSET + i * nscon.IMU_SAMPLE.size + GYRO_OFFSET
+            ox, oy, oz = GYRO_AXES.unpack_from(own, offset)
+            if ox or oy or oz:
+                x, y, z = GYRO_AXES.unpack_from(buf, offset)
+                GYRO_AXES.pack_into(buf, offset, clamp(x + ox), clamp(y + oy), clamp(z + oz))
+
+
+def clamp(value: int) -> int:
+    if value > 32767:
+        return 32767
+    if value < -32768:
+        return -32768
+    return value
+
+
+class OverlayRelay:
+    # Relays a real controller (hidraw) to the gadget like ProConDataLogger,
+    # from the asyncio loop that also reads the input devices, rewriting
+    # input reports on the way. Reports are read into one reused buffer.
+    # The real controller sets the report rate, so the overlay controller's
+    # ReportSec follows the measured interval of its 0x30 reports.
+    def __init__(self, gadget: int, controller: int, overlay: Overlay) -> None:
+        self.gadget = gadget
+        self.controller = controller
+        self.overlay = overlay
+        self.metrics = overlay.procon.metrics
+        self.buf = bytearray(nscon.REPORT_SIZE)
+        self.view = memoryview(self.buf)
+        self.lastReport: int = 0
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        os.set_blocking(self.gadget, False)
+        os.set_blocking(self.controller, False)
+        loop.add_reader(self.gadget, self.fromHost)
+        loop.add_reader(self.controller, self.fromController)
+
+    def stop(self, loop: asyncio.AbstractEventLoop):
+        loop.remove_reader(self.gadget)
+        loop.remove_reader(self.controller)
+
+    def fromHost(self):
+        while True:
+            try:
+                data: bytes = os.read(self.gadget, 128)
+            except BlockingIOError:
+                return
+            write(self.controller, data)
+
+    def fromController(self):
+        buf = self.buf
+        metrics = self.metrics
+        while True:
+            try:
+                length: int = os.readv(self.controller, [buf])
+            except BlockingIOError:
+                return
+            data = buf if length == len(buf) else self.view[:length]
+            if buf[0] != 0x30:
+                write(self.gadget, data)
+                continue
+
+            start: int = time.monotonic_ns()
+            if self.lastReport:
+                self.measure(start - self.lastReport)
+            self.lastReport = start
+            self.overlay.patch(buf, start)
+            patched: int = time.monotonic_ns()
+            sent: bool = write(self.gadget, data)
+            metrics.observe('report_encode', patched - start)
+            metrics.observe('report_write', time.monotonic_ns() - patched)
+            metrics.count('reports_sent' if sent else 'reports_dropped')
+
+    def measure(self, interval: int):
+        # Gaps such as the controller reconnecting are not a report period.
+        procon = self.overlay.procon
+        sec: float = interval / 1e9
+        if sec < procon.ReportSec * 4:
+            procon.ReportSec += (sec - procon.ReportSec) * INTERVAL_WEIGHT
+
+
+def write(fd: int, data) -> bool:
+    try:
+        os.write(fd, data)
+    except BlockingIOError:
+        return False
+    except OSError as e:
+        # The console went to sleep; keep relaying once it is back.
+        if e.errno != errno.ESHUTDOWN:
+            os._exit(1)
+        return False
+    return True
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Relay a real Pro Controller with keyboard and mouse overlaid')
+    parser.add_argument('--hidraw', default='/dev/hidraw0', help='real controller')
+    parser.add_argument('--config', default='config.ini')
+    args = parser.parse_args(argv[1:])
+
+    config_ini: ConfigParser = ConfigParser()
+    if not config_ini.read(args.config, encoding='utf-8'):
+        print('Config File does not exists. Please check config.ini file path.')
+        return 1
+    devconfig: Dict[str, str] = dict(config_ini['DEVICE'])
+    gadget = Gadget(devconfig.get('usbgadget', 'procon'), devconfig.get('udc'),
+                    devconfig.get('hiddevice', '/dev/hidg0'))
+
+    procon = nscon.Controller(gadget.device)
+    try:
+        keymap = compile_keymap(procon.Input, config_ini[devconfig.get('keyconfig', 'KEYCONFIG')])
+        filter_section: str = devconfig.get('gyrofilter', 'GYROFILTER')
+        if filter_section in config_ini:
+            procon.gyroFilters = compile_filters(config_ini[filter_section])
+    except (KeyError, ValueError) as e:
+        print(e)
+        return 1
+    turn_dots: float = float(devconfig['mousedpi']) * \
+        (float(devconfig['mouseturndistance']) / 2.54)
+    procon.Input.Sensor.Gyro.Sensitivity = turn_dots / 180
+    # Starting point until the real reports have been measured.
+    try:
+        report_period: int = int(devconfig.get('reportperiod', '15'))
+    except ValueError:
+        report_period = 0
+    if report_period not in nscon.REPORT_PERIODS:
+        print(f'ReportPeriod must be one of {", ".join(map(str, nscon.REPORT_PERIODS))} (ms).')
+        return 1
+    procon.ReportSec = nscon.REPORT_PERIODS[report_period]
+
+    manager = DeviceManager()
+    specs: List[str] = [spec.strip() for key in ['mouse', 'keyboard']
+                        for spec in devconfig.get(key, '').split(',') if spec.strip()]
+    if specs:
+        for spec in specs:
+            manager.add(spec, procon, keymap)
+    else:
+        # Name the devices in config.ini if the real controller is picked.
+        mouse, keybd = guess_devices()
+        for device in [mouse, keybd]:
+            if device is not None:
+                print(f'Overlay input: {device.path} {device.name}')
+                manager.pin(device, procon, keymap)
+    for binding in manager.resolve():
+        print(f'Input device {binding.spec} not found yet, waiting for it.')
+
+    if not gadget.exists():
+        print(f'ProCon Gadget {gadget.name} does not exists. Please run add_procon_gadget.sh')
+        return 1
+    gadget.reset()
+    if not gadget.waitDevice():
+        print(f'{gadget.device} did not appear after enabling {gadget.name}.')
+        return 1
+
+    relay = OverlayRelay(os.open(gadget.device, os.O_RDWR | os.O_NONBLOCK),
+                         os.open(args.hidraw, os.O_RDWR | os.O_NONBLOCK), Overlay(procon))
+    loop = asyncio.new_event_loop()
+    relay.start(loop)
+    manager.run(loop)
+    metrics_server = MetricsServer([procon],
+                                   config_ini.get('METRICS', 'Socket', fallback=None),
+                                   config_ini.get('METRICS', 'Textfile', fallback=None))
+    loop.run_until_complete(metrics_server.start())
+
+    loop.add_signal_handler(signal.SIGINT, loop.stop)
+    print(f'---- Relaying {args.hidraw} <-> {gadget.device} with keyboard and mouse overlay ----')
+    loop.run_forever()
+
+    relay.stop(loop)
+    manager.close()
+    metrics_server.close()
+    gadget.reset()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import struct
+import sys
+import threading
+import time
+from configparser import ConfigParser
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple
+
+from evdev import InputEvent
+
+import nscon
+from control import OP_GYRO, ControlTarget
+from gyrofilter import FilterChain, parse_chain
+from ingest import EventBatcher
+from keymap import KeyMap, compile_keymap
+
+RECORD_MAGIC: bytes = b'NSPCREC1'
+
+# Every record starts with a one byte tag and a monotonic ns timestamp.
+# Session start: controller lastReport, gyro sensitivity, report period.
+SESSION: struct.Struct = struct.Struct('<cQdd')
+# evdev event: device index, type, code, value.
+EVENT: struct.Struct = struct.Struct('<cQBHHi')
+# 0x30 input report frame as written to the gadget.
+REPORT: struct.Struct = struct.Struct(f'<cQ{nscon.REPORT_SIZE}s')
+# Gyro settings changed within a session (config reload): sensitivity.
+GYRO: struct.Struct = struct.Struct('<cQd')
+# Gyro filter of one axis: axis, spec length, followed by the spec text.
+# Written for all three axes after each session and gyro record.
+FILTER: struct.Struct = struct.Struct('<cQBH')
+# Key configuration of the controller: length, followed by "KEY = TARGET"
+# lines. Written after the session record and on every config reload.
+KEYCONFIG: struct.Struct = struct.Struct('<cQH')
+# Input device lost, its held keys were released: device index.
+RELEASE: struct.Struct = struct.Struct('<cQB')
+# Control API command as applied (control.py): op, arg, a, b, c.
+CONTROL: struct.Struct = struct.Struct('<cQBBddd')
+
+RECORDS: Dict[bytes, struct.Struct] = {b'S': SESSION, b'E': EVENT, b'R': REPORT,
+                                       b'G': GYRO, b'F': FILTER, b'K': KEYCONFIG,
+                                       b'L': RELEASE, b'C': CONTROL}
+# Records whose last field is the length of the text following them.
+VARIABLE: List[bytes] = [b'F', b'K']
+
+
+class Recorder:
+    # Appends the evdev streams fed to EventBatcher, everything else that
+    # changes the controller state (config reloads, lost devices, control
+    # API commands) and every input report sent by the controller. These
+    # arrive from different threads, hence the lock around the buffered file.
+    def __init__(self, path: str, procon: nscon.Controller,
+                 keyconfig: Mapping[str, str] = None) -> None:
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab', buffering=1 << 16)
+        if self.file.tell() == 0:
+            self.file.write(RECORD_MAGIC)
+        self.file.write(SESSION.pack(b'S', procon.lastReport,
+                                     procon.Input.Sensor.Gyro.Sensitivity, procon.ReportSec))
+        self.writeFilters(procon.lastReport, procon.gyroFilters)
+        if keyconfig is not None:
+            self.writeKeyconfig(procon.lastReport, keyconfig)
+        procon.recorder = self
+        self.procon = procon
+
+    def writeFilters(self, timestamp: int, filters: List[Optional[FilterChain]]):
+        for axis, chain in enumerate(filters):
+            spec: bytes = chain.spec.encode() if chain is not None else b''
+            self.file.write(FILTER.pack(b'F', timestamp, axis, len(spec)) + spec)
+
+    def writeKeyconfig(self, timestamp: int, keyconfig: Mapping[str, str]):
+        text: bytes = ''.join(f'{key} = {target}\n' for key, target in keyconfig.items()).encode()
+        self.file.write(KEYCONFIG.pack(b'K', timestamp, len(text)) + text)
+
+    def keyconfig(self, timestamp: int, keyconfig: Mapping[str, str]):
+        with self.lock:
+            self.writeKeyconfig(timestamp, keyconfig)
+
+    def release(self, device: int, timestamp: int):
+        with self.lock:
+            self.file.write(RELEASE.pack(b'L', timestamp, device))
+
+    def control(self, timestamp: int, op: int, arg: int, a: float, b: float, c: float):
+        record: bytes = CONTROL.pack(b'C', timestamp, op, arg, a, b, c)
+        with self.lock:
+            self.file.write(record)
+
+    def gyro(self, timestamp: int, sensitivity: float, filters: List[Optional[FilterChain]]):
+        with self.lock:
+            self.file.write(GYRO.pack(b'G', timestamp, sensitivity))
+            self.writeFilters(timestamp, filters)
+
+    def event(self, device: int, timestamp: int, event):
+        record: bytes = EVENT.pack(b'E', timestamp, device, event.type, event.code, event.value)
+        with self.lock:
+            self.file.write(record)
+
+    def report(self, timestamp: int, frame: bytearray):
+        record: bytes = REPORT.pack(b'R', timestamp, frame)
+        with self.lock:
+            self.file.write(record)
+
+    def close(self):
+        self.procon.recorder = None
+        with self.lock:
+            self.file.close()
+
+
+def read_records(path: str) -> Iterator[Tuple]:
+    with open(path, 'rb') as f:
+        if f.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+            raise ValueError(f'{path} is not a ProCon input recording')
+        while True:
+            tag: bytes = f.read(1)
+            if not tag:
+                return
+            record = RECORDS.get(tag)
+            if record is None:
+                raise ValueError(f'{path}: unknown record tag {tag!r} at {f.tell() - 1}')
+            data: bytes = f.read(record.size - 1)
+            if len(data) < record.size - 1:
+                return
+            fields = record.unpack(tag + data)
+            if tag in VARIABLE:
+                text: bytes = f.read(fields[-1])
+                if len(text) < fields[-1]:
+                    return
+                fields += (text.decode(),)
+            yield fields
+
+
+def parse_keyconfig(text: str) -> Dict[str, str]:
+    keyconfig: Dict[str, str] = {}
+    for line in text.splitlines():
+        key, _, target = line.partition('=')
+        keyconfig[key.strip()] = target.strip()
+    return keyconfig
+
+
+class Replay:
+    # Applies recorded input to a controller: evdev events, key
+    # configuration changes, lost devices and control API commands.
+    def __init__(self, procon: nscon.Controller, keymap: KeyMap) -> None:
+        self.procon = procon
+        self.keymap = keymap
+        self.batchers: Dict[int, EventBatcher] = {}
+        self.control = ControlTarget(procon)
+
+    def apply(self, record: Tuple, timestamp: int) -> bool:
+        tag: bytes = record[0]
+        if tag == b'E':
+            device, etype, code, value = record[2:]
+            batcher = self.batchers.get(device)
+            if batcher is None:
+                batcher = self.batchers[device] = EventBatcher(self.procon, self.keymap, device=device)
+            sec, usec = divmod(timestamp // 1000, 1_000_000)
+            batcher.feed((InputEvent(sec, usec, etype, code, value),), timestamp)
+        elif tag == b'K':
+            self.keymap = compile_keymap(self.procon.Input, parse_keyconfig(record[3]))
+            for batcher in self.batchers.values():
+                batcher.setKeymap(self.keymap)
+        elif tag == b'L':
+            batcher = self.batchers.get(record[2])
+            if batcher is not None:
+                batcher.release()
+        elif tag == b'C':
+            op, arg, a, b, c = record[2:]
+            if op != OP_GYRO:
+                a, b, c = int(a), int(b), int(c)
+            self.control.apply(op, arg, a, b, c, timestamp)
+            self.procon.markInput(timestamp)
+        else:
+            return False
+        return True
+
+
+def verify(path: str, keyconfig: Mapping[str, str], realtime: bool = False) -> Dict[str, int]:
+    # Feeds the recorded input through the keymap and gyro path of a fresh
+    # Controller, regenerates each report at its recorded time and compares
+    # it byte for byte with the recorded one. keyconfig is only used for
+    # sessions that did not record their own.
+    stats: Dict[str, int] = {'sessions': 0, 'events': 0, 'reports': 0, 'mismatches': 0}
+    procon: nscon.Controller = None
+    replay: Replay = None
+    start: int = None
+    wallStart: int = time.monotonic_ns()
+
+    for record in read_records(path):
+        tag, timestamp = record[0], record[1]
+        if realtime:
+            if start is None:
+                start = timestamp
+            delay: int = (timestamp - start) - (time.monotonic_ns() - wallStart)
+            if delay > 0:
+                time.sleep(delay / 1e9)
+
+        if tag == b'S':
+            procon = nscon.Controller(None)
+            procon.lastReport = timestamp
+            procon.Input.Sensor.Gyro.Sensitivity = record[2]
+            procon.ReportSec = record[3]
+            replay = Replay(procon, compile_keymap(procon.Input, keyconfig))
+            stats['sessions'] += 1
+        elif tag == b'G':
+            procon.Input.Sensor.Gyro.Sensitivity = record[2]
+        elif tag == b'F':
+            axis, spec = record[2], record[4]
+            procon.gyroFilters[axis] = parse_chain(spec) if spec else None
+        elif tag == b'R':
+            frame: bytes = record[2]
+            procon.report[1] = frame[1]
+            procon.getSensorBuffer(timestamp)
+            stats['reports'] += 1
+            if procon.report != frame:
+                stats['mismatches'] += 1
+                if stats['mismatches'] <= 10:
+                    print(f'Report mismatch at {timestamp}:')
+                    print(f'\trecorded {frame.hex()}')
+                    print(f'\treplayed {procon.report.hex()}')
+        elif replay.apply(record, timestamp) and tag == b'E':
+            stats['events'] += 1
+
+    return stats
+
+
+async def play(path: str, procon: nscon.Controller, keymap: KeyMap, speed: float = 1.0):
+    # Replays the recorded input into a live controller with the recorded
+    # timing, e.g. for macros, once the host is connected. Reports are left
+    # to the controller's own ticker; speed 0 feeds everything at once.
+    while procon.stopInput:
+        await asyncio.sleep(procon.ReportSec)
+
+    replay = Replay(procon, keymap)
+    start: int = None
+    wallStart: int = time.monotonic_ns()
+    for record in read_records(path):
+        tag, timestamp = record[0], record[1]
+        if tag == b'K':
+            replay.apply(record, time.monotonic_ns())
+            continue
+        if tag not in [b'E', b'L', b'C']:
+            continue
+        if start is None:
+            start = timestamp
+            wallStart = time.monotonic_ns()
+        if speed > 0:
+            delay: float = (timestamp - start) / speed - (time.monotonic_ns() - wallStart)
+            if delay > 0:
+                await asyncio.sleep(delay / 1e9)
+        replay.apply(record, time.monotonic_ns())
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Inspect and verify ProCon input recordings')
+    parser.add_argument('command', choices=['info', 'verify'])
+    parser.add_argument('recording')
+    parser.add_argument('--config', default='config.ini', help='config.ini with the KEYCONFIG of old recordings')
+    parser.add_argument('--keyconfig', default='KEYCONFIG', help='key configuration section')
+    parser.add_argument('--realtime', action='store_true', help='replay with the recorded timing')
+    args = parser.parse_args(argv[1:])
+
+    if args.command == 'info':
+        counts: Dict[bytes, int] = {}
+        first: int = None
+        last: int = None
+        for record in read_records(args.recording):
+            counts[record[0]] = counts.get(record[0], 0) + 1
+            first = record[1] if first is None else first
+            last = record[1]
+        print(f'sessions: {counts.get(b"S", 0)}')
+        print(f'events: {counts.get(b"E", 0)}')
+        print(f'reports: {counts.get(b"R", 0)}')
+        print(f'gyro changes: {counts.get(b"G", 0)}')
+        print(f'key configurations: {counts.get(b"K", 0)}')
+        print(f'device releases: {counts.get(b"L", 0)}')
+        print(f'control commands: {counts.get(b"C", 0)}')
+        if first is not None:
+            print(f'duration: {(last - first) / 1e9:.3f} s')
+        return 0
+
+    config_ini: ConfigParser = ConfigParser()
+    config_ini.read(args.config, encoding='utf-8')
+    stats: Dict[str, int] = verify(args.recording, config_ini[args.keyconfig], args.realtime)
+    for key, value in stats.items():
+        print(f'{key}: {value}')
+    return 1 if stats['mismatches'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
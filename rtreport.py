@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+
+import argparse
+import ctypes
+import gc
+import os
+import struct
+import subprocess
+import sys
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, List, Optional, Tuple
+
+import nscon
+from gyrofilter import compile_filters
+from metrics import COUNTERS, GAUGES, HISTOGRAM_BUCKETS, STAGES, Metrics
+
+# Layout of the shared state block. The converter process is the only
+# writer of everything but COUNT_OFFSET, REPORTED_OFFSET and the stats,
+# which belong to the report process.
+SEQ: struct.Struct = struct.Struct('<I')
+COUNT_OFFSET: int = 4
+STATE_OFFSET: int = 8
+INPUT_SIZE: int = nscon.SENSOR_OFFSET - nscon.INPUT_OFFSET
+# flags, gyro sensitivity, gyro head, oldest unreported input (ns), input
+# bytes of the report frame
+STATE: struct.Struct = struct.Struct(f'<BdIQ{INPUT_SIZE}s')
+# The last of those input timestamps that made it into a written report.
+REPORTED: struct.Struct = struct.Struct('<Q')
+REPORTED_OFFSET: int = (STATE_OFFSET + STATE.size + 7) & ~7
+RING_OFFSET: int = REPORTED_OFFSET + REPORTED.size
+# timestamp and cumulative gyro motion in dots (x, y, z)
+GYRO_ENTRY: struct.Struct = struct.Struct('<Qddd')
+GYRO_SLOTS: int = 32
+# Metrics of the report process behind their own seqlock: counters, gauges,
+# then per stage the histogram buckets, count and sum, then ticker ticks,
+# overruns, errors and mean and max jitter in us.
+STATS_OFFSET: int = RING_OFFSET + GYRO_ENTRY.size * GYRO_SLOTS
+STATS: struct.Struct = struct.Struct(f'<{len(COUNTERS)}Q{len(GAUGES)}d'
+                                     + f'{HISTOGRAM_BUCKETS + 2}Q' * len(STAGES) + '3Q2d')
+STATS_SEC: float = 0.5
+SHARED_SIZE: int = STATS_OFFSET + SEQ.size + STATS.size
+
+# Seqlock reads give up after this many attempts instead of spinning on a
+# writer that died (or cannot run) in the middle of an update.
+READ_RETRIES: int = 1000
+
+FLAG_ACTIVE: int = 0x01
+FLAG_STOP: int = 0x02
+
+MCL_CURRENT: int = 1
+MCL_FUTURE: int = 2
+
+
+class SharedState:
+    # Controller state shared between the converter and the report process,
+    # guarded by a seqlock: the writer makes the sequence odd while it
+    # updates the block and the reader retries until it copied the block
+    # between two identical even sequence values, so it never sees a half
+    # written stick or button update. Gyro motion is a ring of cumulative
+    # totals, so a reader that falls behind loses sample timing, not motion.
+    def __init__(self, name: str = None) -> None:
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=SHARED_SIZE)
+            self.shm.buf[:SHARED_SIZE] = bytes(SHARED_SIZE)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # Only the creating process may unlink the block.
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+            self.owner = False
+        self.buf = self.shm.buf
+        self.name: str = self.shm.name
+
+        # Writer side
+        self.seq: int = 0
+        self.flags: int = 0
+        self.sensitivity: float = 1.0
+        self.input: bytes = bytes(INPUT_SIZE)
+        self.head: int = 0
+        self.pending: int = 0
+        self.gyro: List[float] = [0.0, 0.0, 0.0]
+
+        # Reader side
+        self.tail: int = 0
+        self.seen: List[float] = [0.0, 0.0, 0.0]
+
+        # Stats, written by the report process
+        self.statsSeq: int = 0
+
+    def begin(self):
+        self.seq += 1
+        SEQ.pack_into(self.buf, 0, self.seq)
+
+    def end(self):
+        STATE.pack_into(self.buf, STATE_OFFSET, self.flags, self.sensitivity, self.head,
+                        self.pending, self.input)
+        self.seq += 1
+        SEQ.pack_into(self.buf, 0, self.seq)
+
+    def publish(self, flags: int, sensitivity: float, input: memoryview, pending: int = 0):
+        self.begin()
+        self.flags = flags
+        self.sensitivity = sensitivity
+        self.input = bytes(input)
+        self.pending = pending
+        self.end()
+
+    def addGyro(self, x: float, y: float, z: float, timestamp: int):
+        gyro = self.gyro
+        gyro[0] += x
+        gyro[1] += y
+        gyro[2] += z
+        self.begin()
+        GYRO_ENTRY.pack_into(self.buf, RING_OFFSET + (self.head % GYRO_SLOTS) * GYRO_ENTRY.size,
+                             timestamp, gyro[0], gyro[1], gyro[2])
+        self.head += 1
+        self.end()
+
+    def read(self, seqOffset: int, start: int, end: int) -> Optional[bytes]:
+        buf = self.buf
+        for _ in range(READ_RETRIES):
+            before: int = SEQ.unpack_from(buf, seqOffset)[0]
+            if before & 1:
+                continue
+            block: bytes = bytes(buf[start:end])
+            if SEQ.unpack_from(buf, seqOffset)[0] == before:
+                return block
+        return None
+
+    def snapshot(self) -> Optional[Tuple[int, float, bytes, int, List[Tuple[int, float, float, float]]]]:
+        # Returns flags, sensitivity, input bytes, the oldest unreported input
+        # timestamp and the gyro motion added since the previous snapshot as
+        # (timestamp, dx, dy, dz), or None if no consistent copy could be made.
+        block: Optional[bytes] = self.read(0, STATE_OFFSET, STATS_OFFSET)
+        if block is None:
+            return None
+
+        flags, sensitivity, head, pending, input = STATE.unpack_from(block, 0)
+        motion: List[Tuple[int, float, float, float]] = []
+        tail: int = max(self.tail, head - GYRO_SLOTS)
+        seen = self.seen
+        for index in range(tail, head):
+            offset: int = RING_OFFSET - STATE_OFFSET + (index % GYRO_SLOTS) * GYRO_ENTRY.size
+            timestamp, x, y, z = GYRO_ENTRY.unpack_from(block, offset)
+            motion.append((timestamp, x - seen[0], y - seen[1], z - seen[2]))
+            seen[0], seen[1], seen[2] = x, y, z
+        self.tail = head
+        return flags, sensitivity, input, pending, motion
+
+    def writeStats(self, metrics: Metrics, ticker: Dict[str, float]):
+        values: List = list(metrics.counters.values())
+        values += [metrics.gauges[name] for name in GAUGES]
+        for histogram in metrics.stages.values():
+            values += histogram.buckets
+            values.append(histogram.count)
+            values.append(histogram.sum)
+        values += [ticker['ticks'], ticker['overruns'], ticker['errors'],
+                   ticker['jitter_mean_us'], ticker['jitter_max_us']]
+        self.statsSeq += 1
+        SEQ.pack_into(self.buf, STATS_OFFSET, self.statsSeq)
+        STATS.pack_into(self.buf, STATS_OFFSET + SEQ.size, *values)
+        self.statsSeq += 1
+        SEQ.pack_into(self.buf, STATS_OFFSET, self.statsSeq)
+
+    def readStats(self) -> Optional[Tuple[Metrics, Dict[str, float]]]:
+        block: Optional[bytes] = self.read(STATS_OFFSET, STATS_OFFSET + SEQ.size, SHARED_SIZE)
+        if block is None:
+            return None
+
+        values = STATS.unpack(block)
+        metrics = Metrics()
+        index: int = 0
+        for name in COUNTERS:
+            metrics.counters[name] = values[index]
+            index += 1
+        for name in GAUGES:
+            metrics.gauges[name] = values[index]
+            index += 1
+        for name in STAGES:
+            histogram = metrics.stages[name]
+            histogram.buckets = list(values[index:index + HISTOGRAM_BUCKETS])
+            histogram.count, histogram.sum = values[index + HISTOGRAM_BUCKETS:index + HISTOGRAM_BUCKETS + 2]
+            index += HISTOGRAM_BUCKETS + 2
+        ticks, overruns, errors, mean, peak = values[index:]
+        return metrics, {'ticks': ticks, 'overruns': overruns, 'errors': errors,
+                         'jitter_mean_us': mean, 'jitter_max_us': peak}
+
+    def getReported(self) -> int:
+        return REPORTED.unpack_from(self.buf, REPORTED_OFFSET)[0]
+
+    def setReported(self, timestamp: int):
+        REPORTED.pack_into(self.buf, REPORTED_OFFSET, timestamp)
+
+    def getCount(self) -> int:
+        return self.buf[COUNT_OFFSET]
+
+    def setCount(self, count: int):
+        self.buf[COUNT_OFFSET] = count
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class ReportProcess:
+    # Converter side of the isolated report mode: the controller keeps
+    # handling the handshake, UART and input devices, but only publishes its
+    # state here. The 0x30 reports are timed and written by a separate
+    # process (see run() below) that does not share the GIL with asyncio.
+    process: Optional[subprocess.Popen] = None
+
+    def __init__(self, priority: int = 0, cpus: str = None, mlock: bool = False,
+                 filters: Dict[str, str] = None) -> None:
+        self.priority = priority
+        self.cpus = cpus
+        self.mlock = mlock
+        # GYROFILTER section, the filters run where the IMU samples are made.
+        self.filters: Dict[str, str] = filters or {}
+        self.state = SharedState()
+
+    def start(self, path: str, reportSec: float, enabledAt: int = 0):
+        if self.process is not None:
+            return
+
+        args: List[str] = [sys.executable, os.path.abspath(__file__), self.state.name, path,
+                           '--period', str(reportSec), '--priority', str(self.priority),
+                           '--enabled-at', str(enabledAt)]
+        if self.cpus:
+            args += ['--cpus', self.cpus]
+        if self.mlock:
+            args.append('--mlock')
+        for axis, spec in self.filters.items():
+            args += ['--filter', f'{axis}={spec}']
+        self.process = subprocess.Popen(args)
+
+    def publish(self, active: bool, sensitivity: float, input: memoryview, pending: int = 0):
+        flags: int = FLAG_ACTIVE if active else 0
+        self.state.publish(flags, sensitivity, input, pending)
+
+    def reported(self) -> int:
+        # Input timestamp (see publish) last accounted for in a written report.
+        return self.state.getReported()
+
+    def addGyro(self, x: float, y: float, z: float, timestamp: int):
+        self.state.addGyro(x, y, z, timestamp)
+
+    def getCount(self) -> int:
+        return self.state.getCount()
+
+    def stats(self, own: Metrics) -> Tuple[Metrics, Dict[str, float]]:
+        # The converter's own metrics (handshake, replies, input) plus the
+        # report counters, histograms and ticker stats of the report process.
+        metrics = Metrics()
+        metrics.add(own)
+        metrics.gauges = dict(own.gauges)
+        stats = self.state.readStats()
+        if stats is None:
+            return metrics, {}
+        metrics.add(stats[0])
+        for name, value in stats[0].gauges.items():
+            if value:
+                metrics.gauges[name] = value
+        return metrics, stats[1]
+
+    def stop(self):
+        if self.process is None:
+            return
+
+        state = self.state
+        state.publish(FLAG_STOP, state.sensitivity, state.input, state.pending)
+        try:
+            self.process.wait(1.0)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def close(self):
+        self.stop()
+        self.state.close()
+
+
+def realtime(priority: int, cpus: str, mlock: bool):
+    # Best effort: without CAP_SYS_NICE / CAP_IPC_LOCK the process still
+    # runs, just with normal scheduling.
+    if cpus:
+        try:
+            os.sched_setaffinity(0, {int(cpu) for cpu in cpus.split(',')})
+        except (OSError, ValueError) as e:
+            print(f'Report process: cannot pin to CPUs {cpus}: {e}')
+    if priority > 0:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except OSError as e:
+            print(f'Report process: cannot use SCHED_FIFO {priority}: {e}')
+    if mlock:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+            print(f'Report process: cannot lock memory: {os.strerror(ctypes.get_errno())}')
+
+
+def run(name: str, path: str, reportSec: float, filters: Dict[str, str], enabledAt: int = 0):
+    state = SharedState(name)
+    procon = nscon.Controller(path)
+    procon.ReportSec = reportSec
+    # Same monotonic clock as the converter, so first_report_seconds and
+    # event_to_report are measured as there.
+    procon.enabledAt = enabledAt
+    procon.gyroFilters = compile_filters(filters)
+    try:
+        procon.fp = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError as e:
+        print(f'Report process: cannot open {path}: {e}')
+        os._exit(1)
+    procon.stopCounter = False
+    parent: int = os.getppid()
+    engine = procon.engine
+    gyro = procon.Input.Sensor.Gyro
+    report = procon.report
+
+    statsTicks: int = max(int(STATS_SEC / reportSec), 1)
+    ticks: List[int] = [0]
+    reported: List[int] = [0]
+
+    def tick(elapsed: int):
+        snapshot = state.snapshot()
+        if os.getppid() != parent or (snapshot is not None and snapshot[0] & FLAG_STOP):
+            engine.stopTicker = True
+            return
+
+        # Without a consistent snapshot the previous state is reported again;
+        # the gyro motion is picked up by the next one.
+        pending: int = 0
+        if snapshot is not None:
+            flags, sensitivity, input, pending, motion = snapshot
+            procon.stopInput = not (flags & FLAG_ACTIVE)
+            report[nscon.INPUT_OFFSET:nscon.SENSOR_OFFSET] = input
+            gyro.Sensitivity = sensitivity
+            for timestamp, x, y, z in motion:
+                procon.addGyro(x, y, z, timestamp)
+            if pending != reported[0]:
+                procon.pendingInput = pending
+        procon.Counter(procon.counterSteps(elapsed))
+        procon.InputReport()
+        state.setCount(procon.count)
+        if pending and pending != reported[0] and not procon.pendingInput:
+            reported[0] = pending
+            state.setReported(pending)
+
+        ticks[0] += 1
+        if ticks[0] >= statsTicks:
+            ticks[0] = 0
+            state.writeStats(procon.metrics, task.stats())
+
+    # Whatever is allocated from here on is short lived; keep the collector
+    # from walking the startup objects during a report.
+    gc.freeze()
+    task = engine.add(reportSec, tick)
+    engine.stopTicker = False
+    engine.run()
+    state.writeStats(procon.metrics, task.stats())
+
+    os.close(procon.fp)
+    state.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Isolated ProCon input report process')
+    parser.add_argument('shm', help='shared state block created by the converter')
+    parser.add_argument('hiddevice')
+    parser.add_argument('--period', type=float, default=0.015, help='report period in seconds')
+    parser.add_argument('--priority', type=int, default=0, help='SCHED_FIFO priority, 0 for normal')
+    parser.add_argument('--cpus', help='comma separated CPUs to pin to')
+    parser.add_argument('--mlock', action='store_true', help='lock all memory')
+    parser.add_argument('--filter', action='append', default=[], help='AXIS=SPEC gyro filter chain')
+    parser.add_argument('--enabled-at', type=int, default=0, help='monotonic ns the gadget was enabled at')
+    args = parser.parse_args(argv[1:])
+
+    realtime(args.priority, args.cpus, args.mlock)
+    run(args.shm, args.hiddevice, args.period, dict(spec.split('=', 1) for spec in args.filter),
+        args.enabled_at)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
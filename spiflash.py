@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import mmap
+import os
+from typing import Dict
+
+SPI_FLASH_SIZE: int = 0x80000
+SPI_SECTOR_SIZE: int = 0x1000
+
+
+class SpiFlash:
+    # 512 KB SPI flash image backed by mmap. With a path the image persists
+    # writes and erases to that file, otherwise it lives in anonymous memory.
+    # New images are filled with 0xFF and seeded with {page: bytes} data,
+    # where page is the high byte of the 16 bit address.
+    path: str = None
+
+    def __init__(self, path: str = None, seed: Dict[int, bytes] = {}) -> None:
+        self.path = path
+        if path is None:
+            self.fd = -1
+            self.mm = mmap.mmap(-1, SPI_FLASH_SIZE)
+            self.format(seed)
+        else:
+            exists: bool = os.path.exists(path)
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            size: int = os.fstat(self.fd).st_size
+            if exists and size != SPI_FLASH_SIZE:
+                os.close(self.fd)
+                raise ValueError(f'{path} is not a {SPI_FLASH_SIZE} byte SPI flash image ({size} bytes)')
+            if not exists:
+                os.ftruncate(self.fd, SPI_FLASH_SIZE)
+            self.mm = mmap.mmap(self.fd, SPI_FLASH_SIZE)
+            if not exists:
+                self.format(seed)
+        self.view = memoryview(self.mm)
+
+    def format(self, seed: Dict[int, bytes]):
+        self.mm[:] = b'\xff' * SPI_FLASH_SIZE
+        for page, data in seed.items():
+            self.mm[page << 8:(page << 8) + len(data)] = data
+        self.mm.flush()
+
+    def contains(self, address: int, length: int) -> bool:
+        return 0 <= address and address + length <= SPI_FLASH_SIZE
+
+    def read(self, address: int, length: int) -> memoryview:
+        return self.view[address:address + length]
+
+    def write(self, address: int, data: bytes):
+        self.mm[address:address + len(data)] = data
+        self.mm.flush()
+
+    def erase(self, address: int):
+        start: int = address - address % SPI_SECTOR_SIZE
+        self.mm[start:start + SPI_SECTOR_SIZE] = b'\xff' * SPI_SECTOR_SIZE
+        self.mm.flush()
+
+    def close(self):
+        self.view.release()
+        self.mm.close()
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+
+class TickerTask:
+    # One periodic callback of a Ticker. Deadlines are start + n * period on
+    # the monotonic clock, so a late wake-up never shifts the following ones.
+    # Missed deadlines are skipped, counted as overruns and reported to the
+    # callback as elapsed periods. A callback that raises is counted and
+    # reported once, and keeps being called on the following ticks.
+    ticks: int = 0
+    overruns: int = 0
+    jitterMax: int = 0
+    jitterSum: int = 0
+    errors: int = 0
+
+    def __init__(self, period: float, callback: Callable[[int], None]) -> None:
+        self.period = period
+        self.periodNs: int = int(period * 1_000_000_000)
+        self.callback = callback
+        self.deadline: int = time.monotonic_ns() + self.periodNs
+
+    def fire(self, now: int):
+        late: int = now - self.deadline
+        elapsed: int = 1
+        if late >= self.periodNs:
+            missed: int = late // self.periodNs
+            self.overruns += missed
+            elapsed += missed
+            self.deadline += missed * self.periodNs
+            late -= missed * self.periodNs
+
+        self.ticks += 1
+        self.jitterSum += late
+        if late > self.jitterMax:
+            self.jitterMax = late
+
+        self.deadline += self.periodNs
+        try:
+            self.callback(elapsed)
+        except Exception as e:
+            if not self.errors:
+                print(f'Ticker task {self.callback!r} failed: {e!r}')
+            self.errors += 1
+
+    def stats(self) -> Dict[str, float]:
+        ticks: int = max(self.ticks, 1)
+        return {
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'jitter_mean_us': self.jitterSum / ticks / 1000,
+            'jitter_max_us': self.jitterMax / 1000,
+            'errors': self.errors,
+        }
+
+    def resetStats(self):
+        self.ticks = 0
+        self.overruns = 0
+        self.jitterMax = 0
+        self.jitterSum = 0
+        self.errors = 0
+
+
+class Ticker:
+    # Single timing thread shared by any number of periodic tasks: it sleeps
+    # until the earliest deadline and fires every task that is due.
+    def __init__(self) -> None:
+        self.tasks: List[TickerTask] = []
+        self.stopTicker = True
+        self.wakeup = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def add(self, period: float, callback: Callable[[int], None]) -> TickerTask:
+        task = TickerTask(period, callback)
+        self.tasks = self.tasks + [task]
+        self.wakeup.set()
+        return task
+
+    def remove(self, task: TickerTask):
+        self.tasks = [t for t in self.tasks if t is not task]
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.stopTicker = False
+        self.thread = threading.Thread(target=self.run, name='Ticker', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopTicker = True
+        self.wakeup.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def run(self):
+        while not self.stopTicker:
+            tasks: List[TickerTask] = self.tasks
+            if not tasks:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+
+            deadline: int = min(task.deadline for task in tasks)
+            delay: int = deadline - time.monotonic_ns()
+            if delay > 0:
+                time.sleep(delay / 1_000_000_000)
+
+            now: int = time.monotonic_ns()
+            for task in tasks:
+                if task.deadline <= now:
+                    task.fire(now)